@@ -0,0 +1,132 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Compare two release archives without unpacking them.
+
+import os, sys, bz2, tarfile, hashlib, tempfile, shutil, threading
+from logging import info
+
+import support
+
+def _strip_prefix(name):
+	# Members are named "<archive-name>/..."; the archive names differ between releases
+	parts = os.path.normpath(name).split(os.sep, 1)
+	if len(parts) == 1:
+		return ''
+	return parts[1]
+
+def scan_archive(archive_file):
+	"""Read a .tar.bz2 archive in a single pass.
+	@return: a dict mapping each member's name (without the top-level directory) to a tuple
+	which is the same for two members only if they have the same type, contents, link target and executable bit"""
+	members = {}
+	stream = bz2.BZ2File(archive_file)
+	try:
+		tar = tarfile.open(fileobj = stream, mode = 'r|')
+		while True:
+			tarinfo = tar.next()
+			if tarinfo is None:
+				break
+			tar.members = []
+			if tarinfo.name == 'pax_global_header': continue
+			name = _strip_prefix(tarinfo.name)
+			if not name: continue
+			if tarinfo.isreg():
+				sha = hashlib.sha1()
+				source = tar.extractfile(tarinfo)
+				while True:
+					data = source.read(1 << 16)
+					if not data: break
+					sha.update(data)
+				digest = sha.hexdigest()
+			else:
+				digest = None
+			members[name] = (tarinfo.type, tarinfo.size, digest, tarinfo.mode & 0111, tarinfo.linkname)
+		tar.close()
+	finally:
+		stream.close()
+	return members
+
+def diff_archives(old_archive, new_archive):
+	"""Compare two archives (scanning both at the same time).
+	@return: (added, removed, changed) lists of member names"""
+	old, new = support.parallel_map(scan_archive, [old_archive, new_archive], 2)
+	added = sorted(name for name in new if name not in old)
+	removed = sorted(name for name in old if name not in new)
+	changed = sorted(name for name in new if name in old and old[name] != new[name])
+	return added, removed, changed
+
+class BackgroundDiff:
+	"""Runs diff_archives in a thread, so that the result is ready when the user asks for it."""
+	def __init__(self, old_archive, new_archive):
+		self.old_archive = old_archive
+		self.new_archive = new_archive
+		self.result = None
+		self.error = None
+		self.thread = threading.Thread(target = self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _run(self):
+		try:
+			self.result = diff_archives(self.old_archive, self.new_archive)
+		except:
+			self.error = sys.exc_info()
+
+	def get(self):
+		self.thread.join()
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.result
+
+def _extract_members(archive_file, names, target_dir):
+	# Extract just the named members (and their parent directories) into target_dir
+	os.mkdir(target_dir)
+	stream = bz2.BZ2File(archive_file)
+	try:
+		tar = tarfile.open(fileobj = stream, mode = 'r|')
+		while True:
+			tarinfo = tar.next()
+			if tarinfo is None:
+				break
+			tar.members = []
+			name = _strip_prefix(tarinfo.name)
+			if name not in names or tarinfo.isdir(): continue
+			path = os.path.join(target_dir, name)
+			parent = os.path.dirname(path)
+			if not os.path.isdir(parent):
+				os.makedirs(parent)
+			if tarinfo.isreg():
+				with open(path, 'wb') as target:
+					shutil.copyfileobj(tar.extractfile(tarinfo), target)
+			elif tarinfo.issym():
+				os.symlink(tarinfo.linkname, path)
+		tar.close()
+	finally:
+		stream.close()
+
+def show_diff(old_archive, new_archive, diff):
+	"""Print a summary of diff (as returned by diff_archives) and then show the
+	changed files using support.show_diff."""
+	added, removed, changed = diff
+	for name in removed:
+		print "Removed: %s" % name
+	for name in added:
+		print "Added:   %s" % name
+	for name in changed:
+		print "Changed: %s" % name
+	print "%d added, %d removed, %d changed" % (len(added), len(removed), len(changed))
+
+	if not (added or removed or changed):
+		return
+
+	tmp = tempfile.mkdtemp(prefix = '0release-')
+	try:
+		old_dir = os.path.join(tmp, os.path.basename(old_archive).rsplit('.tar.bz2', 1)[0])
+		new_dir = os.path.join(tmp, os.path.basename(new_archive).rsplit('.tar.bz2', 1)[0])
+		info("Extracting changed files into %s", tmp)
+		_extract_members(old_archive, set(removed + changed), old_dir)
+		_extract_members(new_archive, set(added + changed), new_dir)
+		support.show_diff(old_dir, new_dir)
+	finally:
+		shutil.rmtree(tmp)
@@ -0,0 +1,142 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Release several projects at once ("0release --batch FEED...").
+#
+# Each project is released in its own subdirectory of the current directory
+# (with its own release-status file and lock), by a separate "0release --release"
+# process, since a release changes directory as it goes. First, all the release
+# candidates are prepared at the same time, with --candidate-only. These are the
+# slow, mostly-unattended steps (tests, builds). Then the user reviews all the
+# candidates together, and the accepted ones are published one at a time, so
+# that any questions can be answered.
+#
+# The processes share the on-disk caches (extracted archives, builds).
+#
+# Every project must be in a 0repo repository, since there's no way to give
+# each one its own --master-feed-file.
+
+import os, sys, subprocess, time
+from logging import info
+
+from zeroinstall import SafeException
+
+import support
+
+# Options passed on to each release
+_shared_options = [('key', '--key'), ('builders', '--builders'), ('jobs', '--jobs'),
+		   ('archive_dir_public_url', '--archive-dir-public-url'),
+		   ('archive_upload_command', '--archive-upload-command'),
+		   ('master_feed_upload_command', '--master-feed-upload-command'),
+		   ('upload_jobs', '--upload-jobs'), ('upload_timeout', '--upload-timeout'),
+		   ('public_scm_repository', '--public-scm-repository')]
+
+class Project:
+	def __init__(self, feed_path):
+		self.feed_path = os.path.abspath(feed_path)
+		self.feed = support.load_feed(self.feed_path)
+		self.name = self.feed.get_name()
+		self.releases_dir = os.path.abspath(self.name.lower().replace(' ', '-'))
+		self.log_file = os.path.join(self.releases_dir, 'batch.log')
+		self.error = None
+		self.seconds = None
+		self.choice = None
+
+	def get_status(self):
+		return support.Status(os.path.join(self.releases_dir, 'release-status'))
+
+def _get_args(options):
+	args = [sys.executable, os.path.abspath(sys.argv[0]), '--release']
+	for attr, flag in _shared_options:
+		value = getattr(options, attr)
+		if value is not None:
+			args.append('%s=%s' % (flag, value))
+	if options.verbose:
+		args.append('-' + 'v' * options.verbose)
+	return args
+
+def prepare_candidate(project, args):
+	"""Run the release up to the review, logging to project.log_file."""
+	if not os.path.isdir(project.releases_dir):
+		os.mkdir(project.releases_dir)
+	start = time.time()
+	with open(project.log_file, 'a') as log:
+		with open(os.devnull) as devnull:
+			code = subprocess.call(args + ['--candidate-only', project.feed_path], cwd = project.releases_dir,
+					       stdin = devnull, stdout = log, stderr = subprocess.STDOUT)
+	project.seconds = time.time() - start
+	if code:
+		project.error = "failed with exit code %d (see %s)" % (code, project.log_file)
+
+def check_registered(projects):
+	"""Projects that aren't in a 0repo repository need a --master-feed-file of their own,
+	which we have no way to give them. Check now, rather than after reviewing the candidates."""
+	import release
+	release.use_0repo()
+	from repo import registry
+
+	unregistered = []
+	for p in projects:
+		feed_for = list(p.feed.feed_for)
+		if len(feed_for) != 1 or not registry.lookup(feed_for[0], missing_ok = True):
+			unregistered.append(p.name)
+	if unregistered:
+		raise SafeException("--batch only works for projects in a 0repo repository, and these aren't: %s\n"
+				    "Register them with 0repo or release them separately." % ', '.join(unregistered))
+
+def release_all(feed_paths, options):
+	if options.master_feed_file:
+		raise SafeException("--master-feed-file can't be used with --batch (each project has its own)")
+	if options.release_version:
+		raise SafeException("--release-version can't be used with --batch")
+
+	projects = [Project(path) for path in feed_paths]
+	names = [p.name for p in projects]
+	for p in projects:
+		if names.count(p.name) > 1:
+			raise SafeException("Two feeds are called '%s'" % p.name)
+	check_registered(projects)
+
+	args = _get_args(options)
+	print "Preparing %d release candidates (logs in */batch.log)..." % len(projects)
+	support.parallel_map(lambda p: prepare_candidate(p, args), projects, options.batch_jobs or len(projects))
+
+	print "\nRelease candidates:"
+	for p in projects:
+		status = p.get_status()
+		if p.error:
+			print "- %s : FAILED after %.1fs: %s" % (p.name, p.seconds, p.error)
+		else:
+			print "- %s %s : ready after %.1fs (in %s)" % (p.name, status.release_version, p.seconds,
+					os.path.join(p.releases_dir, status.release_version or ''))
+
+	ready = [p for p in projects if not p.error]
+	if ready:
+		print "\nPlease check the candidates. For each one: publish, fail (delete release-status file), or skip (decide later)?"
+		for p in ready:
+			print "%s %s:" % (p.name, p.get_status().release_version),
+			p.choice = support.get_choice(['Publish', 'Fail', 'Skip'])
+
+	for p in ready:
+		if p.choice == 'Skip': continue
+		print "\n%s %s..." % (p.choice == 'Publish' and 'Publishing' or 'Failing', p.name)
+		flag = p.choice == 'Publish' and '--accept' or '--reject'
+		info("Running %s in %s", args, p.releases_dir)
+		code = subprocess.call(args + [flag, p.feed_path], cwd = p.releases_dir)
+		if code:
+			p.error = "%s failed with exit code %d" % (p.choice.lower(), code)
+
+	print "\nSummary:"
+	for p in projects:
+		if p.error:
+			result = "FAILED: " + p.error
+		elif p.choice == 'Publish':
+			result = "published"
+		elif p.choice == 'Fail':
+			result = "candidate failed"
+		else:
+			result = "not published yet (run again with --batch to resume)"
+		print "- %s : %s" % (p.name, result)
+
+	if [p for p in projects if p.error]:
+		raise SafeException("Some releases failed")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Measure how compress.compress_stream scales with the number of threads.
+# Usage: benchcompress.py [SIZE-IN-MB] [MAX-JOBS]
+
+import sys, os, time, random, subprocess
+from StringIO import StringIO
+from multiprocessing import cpu_count
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import compress
+
+def make_data(size):
+	# Something that compresses roughly like source code
+	rand = random.Random(0)
+	words = ['def', 'release', 'feed', 'archive', 'version', 'self', '(', ')', ':', '\n\t', ' ', '= 0', "'0.1'"]
+	line = ' '.join(rand.choice(words) for i in range(20000))
+	data = []
+	while size > 0:
+		data.append(line)
+		line = line[1:] + line[0]
+		size -= len(line)
+	return ''.join(data)
+
+def time_it(fn):
+	start = time.time()
+	fn()
+	return time.time() - start
+
+def main():
+	size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+	max_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else cpu_count()
+
+	data = make_data(size_mb << 20)
+	print "Compressing %d MB" % (len(data) >> 20)
+
+	def bzip2():
+		child = subprocess.Popen(['bzip2', '-9'], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+		child.communicate(data)
+	base = time_it(bzip2)
+	print "%-12s %7.2fs" % ('bzip2', base)
+
+	jobs = 1
+	while True:
+		t = time_it(lambda: compress.compress_stream(StringIO(data), StringIO(), jobs = jobs))
+		print "%-12s %7.2fs  (x%.2f)" % ('jobs=%d' % jobs, t, base / t)
+		if jobs >= max_jobs: break
+		jobs = min(jobs * 2, max_jobs)
+
+if __name__ == '__main__':
+	main()
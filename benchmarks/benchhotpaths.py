@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Microbenchmarks for the pure-Python code that handles feeds and versions,
+# using inputs the size of a long-lived project's (thousands of versions,
+# large feeds and files).
+#
+# Reports operations/second and the peak extra memory used while running each
+# one, and compares them with the baseline in hotpaths-baseline.json.
+# Usage: benchhotpaths.py [--save-baseline] [--min-time=SECONDS] [NAME...]
+#
+# Run it in the same environment as the tests (zeroinstall, $RELEASE_0REPO and
+# $0TEST). The merge benchmark is skipped without $RELEASE_0REPO and
+# do_version_substitutions without $0TEST, but --save-baseline only saves
+# a baseline that covers every benchmark.
+
+import sys, os, time, json, shutil, tempfile, re, random
+from optparse import OptionParser
+
+mydir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(mydir, '..'))
+
+default_baseline = os.path.join(mydir, 'hotpaths-baseline.json')
+
+feed_template = """<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface" uri="http://example.com/bench.xml">
+  <name>Bench</name>
+  <summary>benchmark feed</summary>
+  <feed-for interface="http://example.com/bench.xml"/>
+  <group arch="%(arch)s" license="OSI Approved :: GNU Lesser General Public License (LGPL)">
+%(impls)s
+  </group>
+</interface>
+"""
+
+impl_template = """    <implementation id="sha1new=%(digest)s" released="2013-01-01" stability="%(stability)s" version="%(version)s">
+      <manifest-digest sha256new="%(digest)s"/>
+      <archive href="http://example.com/releases/%(version)s/bench-%(arch)s-%(version)s.tar.bz2" size="%(size)d"/>
+      <requires interface="http://example.com/lib-%(lib)d.xml"/>
+    </implementation>"""
+
+def make_versions(n):
+	return ['%d.%d.%d' % (i // 1000, (i // 10) % 100, i % 10) for i in range(n)]
+
+def write_feed(path, arch, versions):
+	impls = [impl_template % {'digest': '%040x' % (i * 7919 + len(arch)), 'version': v, 'arch': arch,
+				  'size': 1000 + i, 'lib': i % 10, 'stability': i % 3 and 'stable' or 'testing'}
+		 for i, v in enumerate(versions)]
+	with open(path, 'w') as stream:
+		stream.write(feed_template % {'arch': arch, 'impls': '\n'.join(impls)})
+
+benchmarks = []
+
+def benchmark(name):
+	"""Register a benchmark. The decorated function does any setup in the given
+	temporary directory and returns (fn, n), where each call to fn does n operations."""
+	def register(setup):
+		benchmarks.append((name, setup))
+		return setup
+	return register
+
+@benchmark('suggest_release_version')
+def bench_suggest_release_version(tmp):
+	import support
+	versions = [v + random.choice(['-pre', '-post']) for v in make_versions(1000)]
+	def run():
+		for v in versions:
+			support.suggest_release_version(v)
+	return run, len(versions)
+
+@benchmark('VersionIndex.get_previous')
+def bench_version_index_get_previous(tmp):
+	# (do_release's get_previous_release is just this lookup in the tag index)
+	import support
+	versions = make_versions(5000)
+	index = support.VersionIndex(versions)
+	queries = random.sample(versions, 1000)
+	def run():
+		for v in queries:
+			index.get_previous(v)
+	return run, len(queries)
+
+@benchmark('version_index')
+def bench_version_index(tmp):
+	# Building the index, as for a repository with 5000 release tags
+	import support
+	versions = make_versions(5000)
+	random.shuffle(versions)
+	def run():
+		support.VersionIndex(versions)
+	return run, 1
+
+@benchmark('load_feed')
+def bench_load_feed(tmp):
+	import support
+	path = os.path.join(tmp, 'large.xml')
+	write_feed(path, '*-*', make_versions(2000))
+	def run():
+		support.load_feed(path)
+	return run, 1
+
+@benchmark('make_archives_relative')
+def bench_make_archives_relative(tmp):
+	import support
+	original = os.path.join(tmp, 'merged-orig.xml')
+	path = os.path.join(tmp, 'merged.xml')
+	write_feed(original, '*-*', make_versions(2000))
+	def run():
+		# (includes copying a fresh feed with absolute URLs each time)
+		shutil.copyfile(original, path)
+		support.make_archives_relative(path)
+	return run, 1
+
+@benchmark('merge_feeds')
+def bench_merge_feeds(tmp):
+	# What accept_and_publish does: merge several binary feeds into the source feed
+	from xml.dom import minidom
+	sys.path.insert(0, os.environ['RELEASE_0REPO'])
+	from repo import merge
+	versions = make_versions(500)
+	src_feed = os.path.join(tmp, 'src.xml')
+	write_feed(src_feed, '*-src', versions)
+	binary_feeds = []
+	for i in range(4):
+		binary_feeds.append(os.path.join(tmp, 'binary-%d.xml' % i))
+		write_feed(binary_feeds[-1], 'Linux-arch%d' % i, versions)
+	def run():
+		with open(src_feed, 'rb') as stream:
+			doc = minidom.parse(stream)
+		for b in binary_feeds:
+			with open(b, 'rb') as stream:
+				merge.merge(doc, minidom.parse(stream))
+	return run, 1
+
+@benchmark('do_version_substitutions')
+def bench_do_version_substitutions(tmp):
+	import release
+	impl_dir = os.path.join(tmp, 'impl')
+	os.mkdir(impl_dir)
+	with open(os.path.join(impl_dir, 'big.py'), 'w') as stream:
+		stream.write('# padding\n' * 500000)	# (5 MB)
+		stream.write("version = '0.1'\n")
+	substitutions = [('big.py', re.compile("^version = '(.*)'$", re.M))]
+	versions = make_versions(100)
+	def run():
+		for v in versions:
+			release.do_version_substitutions(impl_dir, substitutions, v)
+	return run, len(versions)
+
+def measure(run, n, min_time):
+	import resource
+	# (before the warm-up, since memory it frees is reused by the later runs)
+	peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	run()		# Warm up
+	calls = 0
+	start = time.time()
+	while True:
+		run()
+		calls += 1
+		elapsed = time.time() - start
+		if elapsed >= min_time:
+			break
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before
+	return {'ops_per_sec': round(calls * n / elapsed, 2), 'peak_kb': peak}
+
+def run_benchmark(setup, min_time):
+	"""Set up and measure a benchmark in a child process, so that ru_maxrss
+	(which starts from the current size after a fork) gives this benchmark's peak."""
+	tmp = tempfile.mkdtemp(prefix = '0release-bench-')
+	try:
+		r, w = os.pipe()
+		child = os.fork()
+		if child == 0:
+			os.close(r)
+			try:
+				random.seed(42)
+				run, n = setup(tmp)
+				result = measure(run, n, min_time)
+			except KeyError, ex:
+				result = {'skipped': 'environment variable %s not set' % ex}
+			except Exception, ex:
+				result = {'error': '%s: %s' % (ex.__class__.__name__, ex)}
+			os.write(w, json.dumps(result))
+			os._exit(0)
+		os.close(w)
+		data = ''
+		while True:
+			chunk = os.read(r, 4096)
+			if not chunk: break
+			data += chunk
+		os.close(r)
+		os.waitpid(child, 0)
+		return json.loads(data)
+	finally:
+		shutil.rmtree(tmp)
+
+def main():
+	parser = OptionParser(usage = "usage: %prog [options] [NAME...]")
+	parser.add_option("", "--baseline", help = "baseline file (default: %default)", default = default_baseline, metavar = 'FILE')
+	parser.add_option("", "--save-baseline", help = "record the results as the new baseline", action = 'store_true')
+	parser.add_option("", "--min-time", help = "run each benchmark for at least this long (default: %default)", type = 'float', default = 1.0, metavar = 'SECONDS')
+
+	(options, args) = parser.parse_args()
+
+	unknown = set(args) - set(name for name, setup in benchmarks)
+	if unknown:
+		parser.error("Unknown benchmark(s): %s" % ', '.join(sorted(unknown)))
+
+	if os.path.exists(options.baseline):
+		with open(options.baseline) as stream:
+			baseline = json.load(stream)['results']
+	else:
+		baseline = {}
+
+	results = {}
+	print "%-26s %12s %10s %12s %8s" % ('benchmark', 'ops/sec', 'peak KB', 'baseline', 'change')
+	for name, setup in benchmarks:
+		if args and name not in args: continue
+		result = results[name] = run_benchmark(setup, options.min_time)
+		if 'ops_per_sec' not in result:
+			print "%-26s %s" % (name, result.get('skipped') and 'skipped (%s)' % result['skipped'] or 'FAILED (%s)' % result['error'])
+			continue
+		old = baseline.get(name, {}).get('ops_per_sec')
+		if old:
+			print "%-26s %12.1f %10d %12.1f %+7.0f%%" % (name, result['ops_per_sec'], result['peak_kb'], old, (result['ops_per_sec'] / old - 1) * 100)
+		else:
+			print "%-26s %12.1f %10d %12s %8s" % (name, result['ops_per_sec'], result['peak_kb'], '-', '-')
+
+	if options.save_baseline:
+		# Keep the old entries for benchmarks we didn't (or couldn't) run
+		for name, result in results.items():
+			if 'ops_per_sec' in result:
+				baseline[name] = result
+		missing = [name for name, setup in benchmarks if name not in baseline]
+		if missing:
+			print "Not saving the baseline, as it would have no results for: %s" % ', '.join(missing)
+			sys.exit(1)
+		with open(options.baseline, 'w') as stream:
+			json.dump({'python': sys.version.split()[0], 'results': baseline}, stream, indent = 1, sort_keys = True, separators = (',', ': '))
+			stream.write('\n')
+		print "Saved baseline in %s" % options.baseline
+
+if __name__ == '__main__':
+	main()
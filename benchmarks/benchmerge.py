@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Time merging a source feed with several binary feeds and making the archive
+# URLs relative, as accept_and_publish does when releasing with 0repo.
+# Compares the old two-pass version (write merged.xml, then parse and rewrite
+# it) with the current single pass.
+# Usage: benchmerge.py [IMPLEMENTATIONS-PER-FEED] [BINARY-FEEDS]
+# Needs $RELEASE_0REPO, like release.py.
+
+import sys, os, time, shutil, tempfile
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.environ['RELEASE_0REPO'])
+
+from repo import merge
+import support
+
+feed_template = """<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface" uri="http://example.com/bench.xml">
+  <name>Bench</name>
+  <summary>benchmark feed</summary>
+  <feed-for interface="http://example.com/bench.xml"/>
+  <group arch="%(arch)s" license="OSI Approved :: GNU Lesser General Public License (LGPL)">
+%(impls)s
+  </group>
+</interface>
+"""
+
+impl_template = """    <implementation id="sha1new=%(digest)s" released="2013-01-01" version="%(version)s">
+      <manifest-digest sha256="%(digest)s"/>
+      <archive href="http://example.com/releases/%(version)s/bench-%(arch)s-%(version)s.tar.bz2" size="%(size)d"/>
+      <requires interface="http://example.com/lib-%(i)d.xml"/>
+    </implementation>"""
+
+def write_feed(path, arch, n_impls):
+	impls = [impl_template % {'digest': '%040x' % (i * 7919 + len(arch)), 'version': '1.%d' % i,
+				  'arch': arch, 'size': 1000 + i, 'i': i % 10} for i in range(n_impls)]
+	with open(path, 'w') as stream:
+		stream.write(feed_template % {'arch': arch, 'impls': '\n'.join(impls)})
+
+def merge_feeds(src_feed, binary_feeds):
+	with open(src_feed, 'rb') as stream:
+		doc = minidom.parse(stream)
+	for b in binary_feeds:
+		with open(b, 'rb') as stream:
+			merge.merge(doc, minidom.parse(stream))
+	return doc
+
+def two_pass(src_feed, binary_feeds):
+	doc = merge_feeds(src_feed, binary_feeds)
+	with open('merged.xml', 'wb') as stream:
+		doc.writexml(stream)
+	support.make_archives_relative('merged.xml')
+
+def single_pass(src_feed, binary_feeds):
+	doc = merge_feeds(src_feed, binary_feeds)
+	support.make_doc_archives_relative(doc)
+	with open('merged.xml', 'wb') as stream:
+		doc.writexml(stream)
+		stream.write(b'\n')
+
+def main():
+	n_impls = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+	n_binaries = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+	tmp = tempfile.mkdtemp(prefix = '0release-bench-')
+	cwd = os.getcwd()
+	try:
+		os.chdir(tmp)
+		write_feed('src.xml', '*-src', n_impls)
+		binary_feeds = []
+		for i in range(n_binaries):
+			binary_feeds.append('binary-%d.xml' % i)
+			write_feed(binary_feeds[-1], 'Linux-arch%d' % i, n_impls)
+
+		print "Merging %d binary feeds into a source feed (%d implementations each)" % (n_binaries, n_impls)
+		results = {}
+		for name, fn in [('two-pass', two_pass), ('single-pass', single_pass)]:
+			start = time.time()
+			fn('src.xml', binary_feeds)
+			print "%-12s %7.2fs" % (name, time.time() - start)
+			results[name] = open('merged.xml').read()
+		assert results['two-pass'] == results['single-pass'], "Output differs!"
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+	main()
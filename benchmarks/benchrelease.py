@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Time complete releases of generated git repositories.
+#
+# For each combination of the values given, this creates a repository with
+# that many files (of the given total size), submodules, existing tags and
+# generate-archive hooks, and runs "0release --release" on it without any
+# interaction. Archives and the master feed are "uploaded" by copying them to
+# local directories, so it works offline. Each release is run with --profile,
+# and the time spent in each phase is written to the JSON results file.
+#
+# Usage: benchrelease.py [--files=100,1000] [--size=1M] [--submodules=0,2] ...
+# Needs the same environment as the tests (e.g. $0TEST, $0PUBLISH and
+# $RELEASE_0REPO, and gpg), so run it under "0launch --command=test" or similar.
+
+import sys, os, time, json, shutil, tempfile, subprocess, itertools, platform
+from optparse import OptionParser
+
+mydir = os.path.dirname(os.path.abspath(__file__))
+zerorelease = os.path.join(mydir, '..', '0release')
+test_gpg = os.path.join(mydir, '..', 'tests', 'gpg.tgz')
+
+feed_template = """<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>Bench</name>
+  <summary>generated project for benchrelease.py</summary>
+
+  <release:management xmlns:release="http://zero-install.sourceforge.net/2007/namespaces/0release">
+%(hooks)s
+  </release:management>
+
+  <feed-for interface="http://example.com/bench/Bench.xml"/>
+
+  <group>
+    <implementation id="." version="1.0-pre"/>
+  </group>
+</interface>
+"""
+
+hook_template = """    <release:action phase="generate-archive">echo "hook %(i)d" > generated-%(i)d.txt</release:action>"""
+
+def parse_size(size):
+	for suffix, scale in [('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)]:
+		if size.upper().endswith(suffix):
+			return int(size[:-1]) * scale
+	return int(size)
+
+def git(args, cwd, env, **kwargs):
+	subprocess.check_call(['git'] + args, cwd = cwd, env = env, **kwargs)
+
+def write_files(directory, n_files, total_size):
+	# Half random, half repeated text, so the files compress about as well as source code does
+	file_size = total_size // max(n_files, 1)
+	for i in range(n_files):
+		subdir = os.path.join(directory, 'dir-%d' % (i // 100))
+		if not os.path.isdir(subdir):
+			os.makedirs(subdir)
+		with open(os.path.join(subdir, 'file-%d.txt' % i), 'wb') as stream:
+			stream.write(os.urandom(file_size // 2).encode('hex')[:file_size // 2])
+			stream.write(('line %d of the benchmark project\n' % i) * (file_size // 2 // 32 + 1))
+
+def make_project(tmp, env, n_files, total_size, n_submodules, n_tags, n_hooks):
+	"""Create the project repository in tmp/bench.
+	@return: the path of its local feed"""
+	project = os.path.join(tmp, 'bench')
+	os.mkdir(project)
+	git(['init', '-q'], project, env)
+	write_files(project, n_files, total_size)
+	with open(os.path.join(project, 'Bench.xml'), 'w') as stream:
+		stream.write(feed_template % {'hooks': '\n'.join(hook_template % {'i': i} for i in range(n_hooks))})
+
+	for i in range(n_submodules):
+		sub = os.path.join(tmp, 'sub-%d' % i)
+		os.mkdir(sub)
+		git(['init', '-q'], sub, env)
+		write_files(sub, max(n_files // 10, 1), total_size // 10)
+		git(['add', '.'], sub, env)
+		git(['commit', '-q', '-m', 'Initial commit'], sub, env)
+		git(['-c', 'protocol.file.allow=always', 'submodule', '-q', 'add', sub, 'sub-%d' % i], project, env)
+
+	git(['add', '.'], project, env)
+	git(['commit', '-q', '-m', 'Initial commit'], project, env)
+
+	if n_tags:
+		# Older releases (all on the same commit; we only care about how many there are)
+		head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = project, env = env).strip()
+		child = subprocess.Popen(['git', 'update-ref', '--stdin'], cwd = project, env = env, stdin = subprocess.PIPE)
+		child.communicate(''.join('create refs/tags/v0.%d %s\n' % (i, head) for i in range(n_tags)))
+		assert child.returncode == 0
+
+	return os.path.join(project, 'Bench.xml')
+
+def summarise_trace(trace_file):
+	with open(trace_file) as stream:
+		events = json.load(stream)['traceEvents']
+	phases = {}
+	categories = {}
+	for event in events:
+		seconds = event['dur'] / 1e6
+		if event['cat'] == 'phase':
+			phases[event['name']] = phases.get(event['name'], 0) + seconds
+		else:
+			categories[event['cat']] = categories.get(event['cat'], 0) + seconds
+	return phases, categories
+
+def run_release(params, keep):
+	tmp = tempfile.mkdtemp(prefix = '0release-bench-')
+	try:
+		env = os.environ.copy()
+		env.update({
+			'http_proxy': 'localhost:1111',		# Make sure we don't use the network
+			'GNUPGHOME': os.path.join(tmp, 'gpg'),
+			'XDG_CONFIG_HOME': os.path.join(tmp, 'config'),
+			'XDG_CACHE_HOME': os.path.join(tmp, 'cache'),
+			'GIT_AUTHOR_NAME': 'Bench', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+			'GIT_COMMITTER_NAME': 'Bench', 'GIT_COMMITTER_EMAIL': 'bench@example.com',
+		})
+		env.pop('ZEROINSTALL_PORTABLE_BASE', None)
+		subprocess.check_call(['tar', 'xzf', test_gpg], cwd = tmp)
+		os.chmod(env['GNUPGHOME'], 0700)
+
+		start = time.time()
+		local_feed = make_project(tmp, env, params['files'], params['size'], params['submodules'], params['tags'], params['hooks'])
+		setup_time = time.time() - start
+
+		# (absolute paths, since the upload commands run in the release's own directory)
+		releases, archives, feeds = [os.path.join(tmp, d) for d in ['releases', 'archives', 'feeds']]
+		for d in [releases, archives, feeds]:
+			os.mkdir(d)
+		trace_file = os.path.join(tmp, 'trace.json')
+
+		cmd = [sys.executable, zerorelease, '--release', local_feed, '-k', 'Testing',
+			'--release-version=1.0',
+			'--profile=' + trace_file,
+			'--archive-dir-public-url=http://TESTING/releases/$RELEASE_VERSION',	# (not checked)
+			'--master-feed-file=' + os.path.join(releases, 'Bench.xml'),
+			'--archive-upload-command=cp "$@" "%s/"' % archives,
+			'--master-feed-upload-command=cp "$@" "%s/"' % feeds]
+		start = time.time()
+		child = subprocess.Popen(cmd, cwd = releases, env = env, stdin = subprocess.PIPE,
+					 stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+		output, unused = child.communicate('P\n\n')
+		wall = time.time() - start
+		if child.returncode:
+			raise Exception("Release failed (exit code %d):\n%s" % (child.returncode, output))
+
+		phases, categories = summarise_trace(trace_file)
+		return {
+			'params': params,
+			'setup': round(setup_time, 3),
+			'wall': round(wall, 3),
+			'archive_size': os.path.getsize(os.path.join(archives, 'bench-1.0.tar.bz2')),
+			'phases': dict((name, round(t, 3)) for name, t in phases.items()),
+			'categories': dict((name, round(t, 3)) for name, t in categories.items()),
+		}
+	finally:
+		if keep:
+			print "Keeping %s" % tmp
+		else:
+			shutil.rmtree(tmp)
+
+def int_list(value):
+	return [parse_size(x) for x in value.split(',')]
+
+def main():
+	parser = OptionParser(usage = "usage: %prog [options]\n\n"
+				"Each option takes a comma-separated list of values; every combination is run.")
+	parser.add_option("", "--files", help = "number of files (default: 100)", default = '100')
+	parser.add_option("", "--size", help = "total size of the files, e.g. 1M (default: 1M)", default = '1M')
+	parser.add_option("", "--submodules", help = "number of submodules (default: 0)", default = '0')
+	parser.add_option("", "--tags", help = "number of existing release tags (default: 10)", default = '10')
+	parser.add_option("", "--hooks", help = "number of generate-archive hooks (default: 0)", default = '0')
+	parser.add_option("", "--repeat", help = "run each combination N times", type = 'int', default = 1, metavar = 'N')
+	parser.add_option("-o", "--output", help = "file to write the results to (default: benchrelease.json)", default = 'benchrelease.json', metavar = 'FILE')
+	parser.add_option("", "--keep", help = "don't delete the temporary directories", action = 'store_true')
+
+	(options, args) = parser.parse_args()
+	if args:
+		parser.print_help()
+		sys.exit(1)
+
+	names = ['files', 'size', 'submodules', 'tags', 'hooks']
+	values = [int_list(getattr(options, name)) for name in names]
+
+	results = []
+	for combination in itertools.product(*values):
+		params = dict(zip(names, combination))
+		for i in range(options.repeat):
+			result = run_release(params, options.keep)
+			print "%s: %.2fs (%s)" % (' '.join('%s=%d' % (name, params[name]) for name in names), result['wall'],
+				', '.join('%s %.2fs' % (name, t) for name, t in sorted(result['phases'].items(), key = lambda x: -x[1])[:4]))
+			results.append(result)
+
+	with open(options.output, 'w') as stream:
+		json.dump({
+			'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'git': subprocess.check_output(['git', '--version']).strip(),
+			'results': results,
+		}, stream, indent = 1, sort_keys = True)
+	print "Results written to %s" % options.output
+
+if __name__ == '__main__':
+	main()
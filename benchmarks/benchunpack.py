@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Compare support.unpack_tarball with the old getmembers()/extract() loop.
+# Usage: benchunpack.py [NUMBER-OF-FILES]
+
+import sys, os, time, copy, shutil, tempfile, tarfile
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import support
+
+def make_archive(path, n_files):
+	tar = tarfile.open(path, 'w:bz2')
+	for d in range(n_files // 100 + 1):
+		info = tarfile.TarInfo('bench/dir-%d' % d)
+		info.type = tarfile.DIRTYPE
+		info.mode = 0755
+		tar.addfile(info)
+		for f in range(min(100, n_files - d * 100)):
+			contents = 'File %d in %d\n' % (f, d)
+			info = tarfile.TarInfo('bench/dir-%d/file-%d' % (d, f))
+			info.size = len(contents)
+			info.mode = 0644
+			tar.addfile(info, StringIO(contents))
+	tar.close()
+
+def old_unpack_tarball(archive_file):
+	tar = tarfile.open(archive_file, 'r:bz2')
+	members = [m for m in tar.getmembers() if m.name != 'pax_global_header']
+	for tarinfo in members:
+		tarinfo = copy.copy(tarinfo)
+		tarinfo.mode |= 0600
+		tarinfo.mode &= 0755
+		tar.extract(tarinfo, '.')
+
+def time_unpack(fn, archive):
+	tmp = tempfile.mkdtemp(prefix = '0release-bench-')
+	cwd = os.getcwd()
+	try:
+		os.chdir(tmp)
+		start = time.time()
+		fn(archive)
+		return time.time() - start
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(tmp)
+
+def main():
+	n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	tmp = tempfile.mkdtemp(prefix = '0release-bench-')
+	try:
+		archive = os.path.join(tmp, 'bench.tar.bz2')
+		make_archive(archive, n_files)
+		print "Unpacking %d files" % n_files
+		old = time_unpack(old_unpack_tarball, archive)
+		print "%-16s %7.2fs" % ('per-member', old)
+		new = time_unpack(support.unpack_tarball, archive)
+		print "%-16s %7.2fs  (x%.2f)" % ('streaming', new, old / new)
+	finally:
+		shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+	main()
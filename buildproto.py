@@ -0,0 +1,163 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# A simple protocol for talking to a build slave over a pair of streams
+# (e.g. the stdin and stdout of "ssh builder 0release --build-slave"), so
+# that the builder doesn't need to share a file-system with us.
+#
+# Each message is a header line "NAME SIZE\n", SIZE bytes of data and then
+# a line with the SHA-256 digest of the data. A NAME of the form "KIND:BASENAME"
+# (e.g. "archive:foo.tar.bz2") means that the data is the contents of a file.
+#
+# To request a build, we send "url", "builder" (the builder's name), "feed:..."
+# and "archive:..." followed by "build". The slave replies with "feed:feed.xml" and the binary "archive:..."
+# followed by "done", or with "error". The slave then waits for another request.
+
+import os, hashlib, tempfile, shutil
+from logging import info
+
+from zeroinstall import SafeException
+
+chunk_size = 1 << 16
+
+class ProtocolError(SafeException):
+	pass
+
+class Connection:
+	def __init__(self, input, output):
+		self.input = input
+		self.output = output
+
+	def send(self, name, data = '', path = None):
+		"""Send data, or the contents of the file path if given."""
+		assert ' ' not in name and '\n' not in name, name
+		sha = hashlib.sha256()
+		if path is None:
+			self.output.write('%s %d\n' % (name, len(data)))
+			self.output.write(data)
+			sha.update(data)
+		else:
+			self.output.write('%s %d\n' % (name, os.path.getsize(path)))
+			with open(path, 'rb') as stream:
+				while True:
+					data = stream.read(chunk_size)
+					if not data: break
+					self.output.write(data)
+					sha.update(data)
+		self.output.write(sha.hexdigest() + '\n')
+		self.output.flush()
+
+	def send_file(self, kind, path):
+		self.send(kind + ':' + os.path.basename(path), path = path)
+
+	def receive(self, directory = None):
+		"""Read the next message. File contents are written into directory.
+		@return: (name, data), where data is the file's path for "KIND:BASENAME" messages, or None at end-of-stream"""
+		header = self.input.readline()
+		if not header:
+			return None
+		try:
+			name, size = header.rstrip('\n').split(' ')
+			size = int(size)
+		except ValueError:
+			raise ProtocolError("Bad message header from build slave: %r" % header)
+
+		sha = hashlib.sha256()
+		if ':' in name:
+			assert directory, "Unexpected file %s" % name
+			basename = name.split(':', 1)[1]
+			if basename != os.path.basename(basename) or basename.startswith('.'):
+				raise ProtocolError("Bad file name %r" % basename)
+			data = os.path.join(directory, basename)
+			with open(data, 'wb') as stream:
+				while size:
+					chunk = self.input.read(min(size, chunk_size))
+					if not chunk:
+						raise ProtocolError("Unexpected end of stream reading %s" % name)
+					stream.write(chunk)
+					sha.update(chunk)
+					size -= len(chunk)
+		else:
+			data = self.input.read(size)
+			if len(data) != size:
+				raise ProtocolError("Unexpected end of stream reading %s" % name)
+			sha.update(data)
+
+		digest = self.input.readline().rstrip('\n')
+		if digest != sha.hexdigest():
+			raise ProtocolError("Digest mismatch for %s (got %s, expected %s)" % (name, sha.hexdigest(), digest))
+		return name, data
+
+def request_build(conn, src_feed, archive_file, archive_dir_public_url, target_feed, builder):
+	"""Ask the slave at the other end of conn to build archive_file. The binary archive
+	is written to the directory containing target_feed."""
+	conn.send('url', archive_dir_public_url)
+	conn.send('builder', builder)
+	conn.send_file('feed', src_feed)
+	conn.send_file('archive', archive_file)
+	conn.send('build')
+
+	# Every slave calls its feed "feed.xml", and builds for several targets may be
+	# running at once, so receive the files into a directory of our own first
+	target_dir = os.path.dirname(os.path.abspath(target_feed))
+	tmpdir = tempfile.mkdtemp(prefix = '.0release-receive-', dir = target_dir)
+	try:
+		while True:
+			msg = conn.receive(tmpdir)
+			if msg is None:
+				raise ProtocolError("Build slave closed the connection")
+			name, data = msg
+			if name == 'done':
+				return
+			elif name == 'error':
+				raise SafeException("Build failed: %s" % data)
+			elif name.startswith('feed:'):
+				os.rename(data, target_feed)
+			elif name.startswith('archive:'):
+				os.rename(data, os.path.join(target_dir, os.path.basename(data)))
+				info("Received binary archive %s", os.path.basename(data))
+			else:
+				raise ProtocolError("Unexpected message %s from build slave" % name)
+	finally:
+		shutil.rmtree(tmpdir)
+
+def serve(conn, build):
+	"""Handle build requests from conn until it is closed, calling
+	build(src_feed, archive_file, archive_dir_public_url, target_feed, builder) for each one.
+	Exceptions from build are reported back to the other end."""
+	while True:
+		tmpdir = tempfile.mkdtemp(prefix = '0release-slave-')
+		try:
+			request_dir = os.path.join(tmpdir, 'request')
+			os.mkdir(request_dir)
+			request = {}
+			while True:
+				msg = conn.receive(request_dir)
+				if msg is None:
+					if request:
+						raise ProtocolError("Connection closed in the middle of a request")
+					return
+				name, data = msg
+				if name == 'build':
+					break
+				request[name.split(':', 1)[0]] = data
+
+			results_dir = os.path.join(tmpdir, 'results')
+			os.mkdir(results_dir)
+			target_feed = os.path.join(results_dir, 'feed.xml')
+			cwd = os.getcwd()
+			try:
+				build(request['feed'], request['archive'], request['url'], target_feed, request.get('builder', None))
+			except Exception, ex:
+				conn.send('error', str(ex) or ex.__class__.__name__)
+				continue
+			finally:
+				os.chdir(cwd)
+
+			conn.send_file('feed', target_feed)
+			for name in os.listdir(results_dir):
+				if name != 'feed.xml':
+					conn.send_file('archive', os.path.join(results_dir, name))
+			conn.send('done')
+		finally:
+			shutil.rmtree(tmpdir)
@@ -1,12 +1,13 @@
 # Copyright (C) 2009, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import tempfile, shutil, os, sys
+import tempfile, shutil, os, sys, subprocess, time, hashlib
 import ConfigParser
+from zeroinstall import SafeException
 from logging import info
 from zeroinstall.support import basedir, portable_rename
 
-import support
+import support, buildproto, tracing
 
 class Compiler:
 	def __init__(self, options, src_feed_name, release_version):
@@ -47,45 +48,95 @@ class Compiler:
 			self.targets = []
 
 	# We run the build in a sub-process. The idea is that the build may need to run
-	# on a different machine.
+	# on a different machine. Each target has its own builder, so we run them at
+	# the same time (up to the 'max-builds' limit in builders.conf).
 	def build_binaries(self):
 		if not self.targets: return
 
 		print "Source package, so generating binaries..."
 
+		max_builds = self.get('global', 'max-builds', None)
+		if max_builds:
+			max_builds = int(max_builds)
+		else:
+			max_builds = len(self.targets)
+
+		results = support.parallel_map(self._build_target, self.targets, max_builds)
+
+		print "\nBuild summary:"
+		failed = []
+		for target, (seconds, error) in zip(self.targets, results):
+			if error:
+				print "- %s : FAILED after %.1fs: %s (see build-%s.log)" % (target, seconds, error, target)
+				failed.append(target)
+			elif seconds is None:
+				print "- %s : already built" % target
+			else:
+				print "- %s : built in %.1fs" % (target, seconds)
+		if failed:
+			raise SafeException("Failed to build binaries for: %s" % ', '.join(failed))
+
+	def _build_target(self, target):
+		"""Build the binary for one target, logging to build-<target>.log.
+		@return: (seconds, error), where seconds is None if it was already built"""
 		archive_file = support.get_archive_basename(self.src_impl)
 
-		for target in self.targets:
-			start = self.get('builder-' + target, 'start', None)
-			command = self.config.get('builder-' + target, 'build')
-			stop = self.get('builder-' + target, 'stop', None)
+		start = self.get('builder-' + target, 'start', None)
+		command = self.config.get('builder-' + target, 'build')
+		stop = self.get('builder-' + target, 'stop', None)
 
-			binary_feed = 'binary-' + target + '.xml'
-			if os.path.exists(binary_feed):
-				print "Feed %s already exists; not rebuilding" % binary_feed
-			else:
-				print "\nBuilding binary with builder '%s' ...\n" % target
+		binary_feed = 'binary-' + target + '.xml'
+		if os.path.exists(binary_feed):
+			print "Feed %s already exists; not rebuilding" % binary_feed
+			return None, None
 
-				if start: support.show_and_run(start, [])
+		log_file = 'build-' + target + '.log'
+		print "Building binary with builder '%s' (log in %s) ..." % (target, log_file)
+		start_time = time.time()
+		span = tracing.begin('build ' + target, 'build')
+		try:
+			with open(log_file, 'w') as log:
+				# (tells the slave which builder it is, for its build cache; older slaves ignore it)
+				env = os.environ.copy()
+				env['0RELEASE_BUILDER'] = target
+				output = {'stdout': log, 'stderr': subprocess.STDOUT, 'env': env}
+				if start: support.show_and_run(start, [], **output)
 				try:
 					args = [os.path.basename(self.src_feed_name), archive_file, self.archive_dir_public_url, binary_feed + '.new']
-					if not command:
+					if self.get('builder-' + target, 'protocol', None) == 'stream':
+						# The command runs "0release --build-slave" (with no arguments) somewhere
+						print "Executing: %s (streaming)" % command
+						child = subprocess.Popen(['sh', '-c', command], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = log, env = env)
+						try:
+							buildproto.request_build(buildproto.Connection(child.stdout, child.stdin), *args, builder = target)
+						finally:
+							child.stdin.close()
+							code = child.wait()
+						if code:
+							raise SafeException("Command failed with exit code %d:\n%s" % (code, command))
+					elif not command:
 						assert target == 'host', 'Missing build command'
-						support.check_call([sys.executable, sys.argv[0], '--build-slave'] + args)
+						support.check_call([sys.executable, sys.argv[0], '--build-slave'] + args, **output)
 					else:
-						support.show_and_run(command, args)
+						support.show_and_run(command, args, **output)
 				finally:
-					if stop: support.show_and_run(stop, [])
+					if stop: support.show_and_run(stop, [], **output)
 
-				bin_feed = support.load_feed(binary_feed + '.new')
-				bin_impl = support.get_singleton_impl(bin_feed)
-				bin_archive_file = support.get_archive_basename(bin_impl)
-				bin_size = bin_impl.download_sources[0].size
+			bin_feed = support.load_feed(binary_feed + '.new')
+			bin_impl = support.get_singleton_impl(bin_feed)
+			bin_archive_file = support.get_archive_basename(bin_impl)
+			bin_size = bin_impl.download_sources[0].size
 
-				assert os.path.exists(bin_archive_file), "Compiled binary '%s' not found!" % os.path.abspath(bin_archive_file)
-				assert os.path.getsize(bin_archive_file) == bin_size, "Compiled binary '%s' has wrong size!" % os.path.abspath(bin_archive_file)
+			assert os.path.exists(bin_archive_file), "Compiled binary '%s' not found!" % os.path.abspath(bin_archive_file)
+			assert os.path.getsize(bin_archive_file) == bin_size, "Compiled binary '%s' has wrong size!" % os.path.abspath(bin_archive_file)
 
-				portable_rename(binary_feed + '.new', binary_feed)
+			portable_rename(binary_feed + '.new', binary_feed)
+			span.add_bytes(bin_size)
+		except Exception, ex:
+			return time.time() - start_time, str(ex) or ex.__class__.__name__
+		finally:
+			span.end()
+		return time.time() - start_time, None
 
 	def get_binary_feeds(self):
 		return ['binary-%s.xml' % target for target in self.targets]
@@ -96,8 +147,44 @@ class Compiler:
 		except ConfigParser.NoOptionError:
 			return default
 
-# This is the actual build process, running on the build machine
-def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed):
+# Builds are cached in a directory named after the source archive's digest, the
+# builder's name (from builders.conf) and the version of 0compile.
+# The download URL is included too, as it appears in the binary feed.
+def get_build_cache_dir(COMPILE, archive_file, archive_dir_public_url, builder):
+	child = subprocess.Popen(COMPILE + ['--version'], stdout = subprocess.PIPE)
+	stdout, unused = child.communicate()
+	if child.returncode:
+		raise SafeException("Command failed with exit code %d:\n%s" % (child.returncode, ' '.join(COMPILE + ['--version'])))
+	compile_version = (stdout.split('\n') + [''])[0].strip()
+
+	key = hashlib.sha256()
+	for part in [support.get_archive_digest(archive_file), builder, compile_version, archive_dir_public_url]:
+		key.update(part + '\0')
+	return os.path.join(basedir.save_cache_path('0install.net', '0release', 'builds'), key.hexdigest())
+
+def save_build(cache_dir, feed, archive):
+	tmp = tempfile.mkdtemp(prefix = 'tmp-', dir = os.path.dirname(cache_dir))
+	try:
+		shutil.copyfile(archive, os.path.join(tmp, os.path.basename(archive)))
+		shutil.copyfile(feed, os.path.join(tmp, 'feed.xml'))
+		try:
+			portable_rename(tmp, cache_dir)
+		except OSError:
+			if not os.path.isdir(cache_dir): raise
+			# Another build of the same thing finished first; keep that one
+			info("%s was saved by another build", cache_dir)
+			shutil.rmtree(tmp)
+			return
+	except:
+		shutil.rmtree(tmp)
+		raise
+	info("Saved build in %s", cache_dir)
+
+# This is the actual build process, running on the build machine.
+# builder is the name of the builder that requested it. When run as a command,
+# this comes from $0RELEASE_BUILDER, which a remote build command may not pass
+# on; without it, the build isn't cached.
+def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed, builder = None):
 	try:
 		COMPILE = [os.environ['0COMPILE']]
 	except KeyError:
@@ -112,13 +199,25 @@ def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed):
 
 	impl, = feed.implementations.values()
 
+	if builder:
+		cache_dir = get_build_cache_dir(COMPILE, archive_file, archive_dir_public_url, builder)
+	else:
+		info("Builder name not given; not using the build cache")
+		cache_dir = None
+	if cache_dir and os.path.isdir(cache_dir):
+		print "Using cached build from %s (delete it to force a rebuild)" % cache_dir
+		cached_archive, = [name for name in os.listdir(cache_dir) if name != 'feed.xml']
+		shutil.copyfile(os.path.join(cache_dir, cached_archive), os.path.join(os.path.dirname(target_feed), cached_archive))
+		shutil.copyfile(os.path.join(cache_dir, 'feed.xml'), target_feed)
+		return
+
 	tmpdir = tempfile.mkdtemp(prefix = '0release-')
 	try:
 		os.chdir(tmpdir)
 		depdir = os.path.join(tmpdir, 'dependencies')
 		os.mkdir(depdir)
 
-		support.unpack_tarball(archive_file)
+		support.unpack_tarball_cached(archive_file)
 		portable_rename(impl.download_sources[0].extract, os.path.join(depdir, impl.id))
 
 		config = ConfigParser.RawConfigParser()
@@ -144,6 +243,9 @@ def build_slave(src_feed, archive_file, archive_dir_public_url, target_feed):
 		archive_file = support.get_archive_basename(impl)
 
 		shutil.move(archive_file, os.path.join(os.path.dirname(target_feed), archive_file))
+
+		if cache_dir:
+			save_build(cache_dir, target_feed, os.path.join(os.path.dirname(target_feed), archive_file))
 	except:
 		print "\nLeaving temporary directory %s for inspection...\n" % tmpdir
 		raise
@@ -0,0 +1,160 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Parallel bzip2 compression.
+#
+# The input is split into chunks which are compressed independently (and
+# concurrently, as the bz2 module releases the GIL while compressing). Each
+# chunk becomes exactly one bzip2 block, and the blocks are then spliced
+# together into a single bzip2 stream. We can't simply concatenate separate
+# streams (as pbzip2 does), because Python 2's bz2 module (and therefore
+# tarfile) stops reading at the end of the first stream.
+
+import bz2, binascii, threading, collections, sys
+import Queue
+
+level = 9
+
+# Each chunk must compress to a single block. A block holds at most
+# 100000 * level - 19 bytes after bzip2's initial run-length encoding, which
+# can expand the input by up to 25%, so leave plenty of room.
+chunk_size = 100000 * level * 7 // 10
+
+_block_magic = 0x314159265359
+_eos_magic = 0x177245385090
+
+def _compress_chunk(data):
+	"""Compress data as a single bzip2 block.
+	@return: (block_crc, nbits, bits)"""
+	stream = bz2.compress(data, level)
+	total = len(stream) * 8
+	value = int(binascii.hexlify(stream), 16)
+
+	# The stream ends with the end-of-stream magic, the combined CRC and 0-7 bits of padding
+	for pad in range(8):
+		if (value >> (pad + 32)) & 0xffffffffffff == _eos_magic:
+			break
+	else:
+		raise Exception("Can't find end of bzip2 stream!")
+
+	crc = (value >> pad) & 0xffffffff
+	nbits = total - 32 - 80 - pad		# Everything between the 'BZh9' header and the trailer
+
+	assert (value >> (total - 32 - 48)) & 0xffffffffffff == _block_magic, "Missing block header"
+	# For a single block, the combined CRC is just the block's CRC
+	assert (value >> (total - 32 - 80)) & 0xffffffff == crc, "Chunk didn't fit in one block!"
+
+	return crc, nbits, (value >> (pad + 80)) & ((1 << nbits) - 1)
+
+class _BitWriter:
+	def __init__(self, stream):
+		self.stream = stream
+		self.value = 0
+		self.nbits = 0
+
+	def write(self, value, nbits):
+		value |= self.value << nbits
+		nbits += self.nbits
+		spare = nbits % 8
+		if nbits >= 8:
+			self.stream.write(binascii.unhexlify('%0*x' % ((nbits - spare) // 4, value >> spare)))
+		self.value = value & ((1 << spare) - 1)
+		self.nbits = spare
+
+	def flush(self):
+		if self.nbits:
+			self.write(0, 8 - self.nbits)
+
+class _Chunk:
+	def __init__(self, data):
+		self.data = data
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+
+	def run(self):
+		try:
+			self.result = _compress_chunk(self.data)
+		except:
+			self.error = sys.exc_info()
+		self.data = None
+		self.done.set()
+
+	def get(self):
+		while not self.done.wait(1):
+			pass
+		if self.error:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.result
+
+def _compress_chunks(src, jobs):
+	"""Read src in chunks and yield the compressed blocks, in order."""
+	if jobs <= 1:
+		while True:
+			data = src.read(chunk_size)
+			if not data: return
+			yield _compress_chunk(data)
+
+	queue = Queue.Queue()
+	def worker():
+		while True:
+			chunk = queue.get()
+			if chunk is None: return
+			chunk.run()
+
+	workers = [threading.Thread(target = worker) for i in range(jobs)]
+	for w in workers:
+		w.daemon = True
+		w.start()
+
+	try:
+		# Keep a few chunks queued up so that the workers never wait for us,
+		# without reading the whole input into memory.
+		pending = collections.deque()
+		eof = False
+		while True:
+			while not eof and len(pending) < jobs * 2:
+				data = src.read(chunk_size)
+				if data:
+					chunk = _Chunk(data)
+					pending.append(chunk)
+					queue.put(chunk)
+				else:
+					eof = True
+			if not pending:
+				break
+			yield pending.popleft().get()
+	finally:
+		for w in workers:
+			queue.put(None)
+		for w in workers:
+			w.join()
+
+class _CountingReader:
+	def __init__(self, stream):
+		self.stream = stream
+		self.size = 0
+
+	def read(self, n):
+		data = self.stream.read(n)
+		self.size += len(data)
+		return data
+
+def compress_stream(src, dst, jobs = None):
+	"""Read all of src and write it to dst as a single bzip2 stream.
+	@param jobs: number of threads to use (default: one per CPU)
+	@return: the number of uncompressed bytes read"""
+	if jobs is None:
+		from multiprocessing import cpu_count
+		jobs = cpu_count()
+	dst.write('BZh%d' % level)
+	out = _BitWriter(dst)
+	combined_crc = 0
+	reader = _CountingReader(src)
+	for crc, nbits, bits in _compress_chunks(reader, jobs):
+		out.write(bits, nbits)
+		combined_crc = (((combined_crc << 1) & 0xffffffff) | (combined_crc >> 31)) ^ crc
+	out.write(_eos_magic, 48)
+	out.write(combined_crc, 32)
+	out.flush()
+	return reader.size
@@ -0,0 +1,127 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Edit a feed in-process, applying several changes with a single parse and write.
+# This handles the edits we make to local feeds; support.publish uses 0publish
+# for anything else (e.g. merging into and signing the master feed).
+
+import time, codecs
+from xml.dom import minidom, Node
+
+from zeroinstall import SafeException
+from zeroinstall.injector import namespaces
+from zeroinstall.zerostore import manifest
+from zeroinstall.support import portable_rename
+
+XMLNS_IFACE = namespaces.XMLNS_IFACE
+
+def _is_local_id(id):
+	return id.startswith('.') or id.startswith('/')
+
+def _child_elements(elem, name):
+	return [x for x in elem.childNodes if x.nodeType == Node.ELEMENT_NODE and x.namespaceURI == XMLNS_IFACE and x.localName == name]
+
+def _indent_of(elem):
+	prev = elem.previousSibling
+	if prev is not None and prev.nodeType == Node.TEXT_NODE and '\n' in prev.data:
+		return prev.data.rsplit('\n', 1)[1]
+	return ''
+
+def get_manifest_digest(directory, alg_name):
+	"""Calculate the manifest digest of directory (without writing a .manifest file)."""
+	alg = manifest.get_algorithm(alg_name)
+	digest = alg.new_digest()
+	for line in alg.generate_manifest(directory):
+		digest.update(line + '\n')
+	return alg.getID(digest)
+
+class FeedEditor:
+	def __init__(self, feed_path):
+		self.feed_path = feed_path
+		with open(feed_path, 'rb') as stream:
+			self.doc = minidom.parse(stream)
+
+	def get_implementations(self):
+		return self.doc.getElementsByTagNameNS(XMLNS_IFACE, 'implementation')
+
+	def get_local_implementation(self):
+		impls = [impl for impl in self.get_implementations()
+			 if impl.hasAttribute('local-path') or _is_local_id(impl.getAttribute('id'))]
+		if len(impls) != 1:
+			raise SafeException("Feed '%s' contains %d local implementations! I need exactly one!" % (self.feed_path, len(impls)))
+		return impls[0]
+
+	def _set_inherited(self, impl, name, value):
+		# Change the attribute where it is set now (the implementation or one of its groups)
+		elem = impl
+		while elem.nodeType == Node.ELEMENT_NODE and elem.localName in ('implementation', 'group'):
+			if elem.hasAttribute(name):
+				break
+			elem = elem.parentNode
+		else:
+			elem = impl
+		if value:
+			elem.setAttribute(name, value)
+		elif elem.hasAttribute(name):
+			elem.removeAttribute(name)
+
+	def set_version(self, version):
+		self._set_inherited(self.get_local_implementation(), 'version', version)
+
+	def set_released(self, released):
+		"""@param released: a date, 'today', or '' to remove it"""
+		if released == 'today':
+			released = time.strftime('%Y-%m-%d')
+		self._set_inherited(self.get_local_implementation(), 'released', released)
+
+	def set_main(self, main):
+		self._set_inherited(self.get_local_implementation(), 'main', main)
+
+	def set_stability(self, stability, select_version):
+		"""Set the stability of every implementation with version select_version."""
+		for impl in self.get_implementations():
+			elem = impl
+			while not elem.hasAttribute('version') and elem.parentNode.nodeType == Node.ELEMENT_NODE:
+				elem = elem.parentNode
+			if elem.getAttribute('version') == select_version:
+				impl.setAttribute('stability', stability)
+
+	def add_archive(self, href, size, extract, digests):
+		"""Turn the local implementation into one downloaded from href.
+		@param digests: the archive's manifest digests, as (sha1new, sha256new)"""
+		impl = self.get_local_implementation()
+		sha1new, sha256new = digests
+		impl.setAttribute('id', sha1new)
+		if impl.hasAttribute('local-path'):
+			impl.removeAttribute('local-path')
+
+		indent = _indent_of(impl) + '  '
+		for existing in _child_elements(impl, 'manifest-digest'):
+			impl.removeChild(existing)
+		digest = self.doc.createElementNS(XMLNS_IFACE, 'manifest-digest')
+		digest.setAttribute('sha256new', sha256new.split('_', 1)[1])
+
+		archive = self.doc.createElementNS(XMLNS_IFACE, 'archive')
+		if extract:
+			archive.setAttribute('extract', extract)
+		archive.setAttribute('href', href)
+		archive.setAttribute('size', str(size))
+
+		last = impl.lastChild
+		closing = _indent_of(impl)
+		if last is not None and last.nodeType == Node.TEXT_NODE and not last.data.strip():
+			impl.removeChild(last)
+		for elem in [digest, archive]:
+			impl.appendChild(self.doc.createTextNode('\n' + indent))
+			impl.appendChild(elem)
+		impl.appendChild(self.doc.createTextNode('\n' + closing))
+
+	def save(self):
+		tmp = self.feed_path + '.new'
+		with open(tmp, 'wb') as stream:
+			writer = codecs.getwriter('utf-8')(stream)
+			writer.write(u'<?xml version="1.0" ?>\n')
+			for node in self.doc.childNodes:
+				node.writexml(writer)
+				writer.write(u'\n')
+		portable_rename(tmp, self.feed_path)
@@ -1,17 +1,13 @@
 # Copyright (C) 2009, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import os, subprocess, shutil, sys, re
+import os, shutil, sys, re, time, threading
 from xml.dom import minidom
 from zeroinstall import SafeException
-from zeroinstall.injector import model
-from zeroinstall.support import ro_rmtree
+from zeroinstall.support import portable_rename
 from logging import info, warn
 
-sys.path.insert(0, os.environ['RELEASE_0REPO'])
-from repo import registry, merge
-
-import support, compile
+import support, compile, archivediff, signing, tracing, sandbox
 from scm import get_scm
 
 XMLNS_RELEASE = 'http://zero-install.sourceforge.net/2007/namespaces/0release'
@@ -22,15 +18,27 @@ TMP_BRANCH_NAME = '0release-tmp'
 
 test_command = os.environ['0TEST']
 
-def run_unit_tests(local_feed):
+def use_0repo():
+	"""Make 0repo's modules (from $RELEASE_0REPO) importable. They're only needed
+	once we get as far as publishing, so we don't load them before then."""
+	path = os.environ['RELEASE_0REPO']
+	if path not in sys.path:
+		sys.path.insert(0, path)
+
+@tracing.traced('run unit-tests')
+def run_unit_tests(local_feed, test_sandbox = None):
 	print "Running self-tests..."
-	exitstatus = subprocess.call([test_command, '--', local_feed])
+	command = [test_command, '--', local_feed]
+	if test_sandbox:
+		command = test_sandbox.wrap(command)
+	exitstatus = tracing.Popen(command).wait()
 	if exitstatus == 2:
 		print "SKIPPED unit tests for %s (no 'test' command)" % local_feed
 		return
 	if exitstatus:
 		raise SafeException("Self-test failed with exit status %d" % exitstatus)
 
+@tracing.traced('upload archives')
 def upload_archives(options, status, uploads):
 	# For each binary or source archive in uploads, ensure it is available
 	# from options.archive_dir_public_url
@@ -43,21 +51,89 @@ def upload_archives(options, status, uploads):
 		return support.get_archive_url(options, status.release_version, archive)
 
 	# Check that url exists and has the given size
-	def is_uploaded(url, size):
+	# Returns None if so, or a description of the problem
+	def check_upload(url, size):
 		if url.startswith('http://TESTING/releases'):
-			return True
+			return None
 
-		print "Testing URL %s..." % url
 		try:
-			actual_size = int(support.get_size(url))
+			with tracing.span('check ' + url, 'network'):
+				actual_size = int(support.get_size(url))
 		except Exception, ex:
-			print "Can't get size of '%s': %s" % (url, ex)
-			return False
+			return "Can't get size of '%s': %s" % (url, ex)
 		else:
 			if actual_size == size:
-				return True
-			print "WARNING: %s exists, but size is %d, not %d!" % (url, actual_size, size)
-			return False
+				return None
+			return "WARNING: %s exists, but size is %d, not %d!" % (url, actual_size, size)
+
+	# Check all the uploads in indexes at once. Keep polling (with increasing delays)
+	# until they all appear or options.upload_timeout seconds have passed.
+	# Returns the indexes of the archives that are still missing.
+	@tracing.traced('verify uploads', 'upload')
+	def verify_uploads(indexes):
+		if not indexes:
+			return set()
+		checks = dict((i, (url(uploads[i]), os.path.getsize(uploads[i]))) for i in indexes)
+		for i in indexes:
+			print "Testing URL %s..." % checks[i][0]
+		deadline = time.time() + (options.upload_timeout or 0)
+		delay = 1
+		missing = indexes
+		while True:
+			problems = support.parallel_map(lambda i: check_upload(*checks[i]), missing, len(missing))
+			failed = [(i, problem) for i, problem in zip(missing, problems) if problem]
+			if not failed or time.time() + delay > deadline:
+				for i, problem in failed:
+					print problem
+				return set(i for i, problem in failed)
+			missing = [i for i, problem in failed]
+			print "%d upload(s) not available yet; checking again in %d seconds..." % (len(missing), delay)
+			time.sleep(delay)
+			delay = min(delay * 2, 60)
+
+	# status.upload_attempts records, for each archive we've tried to upload,
+	# the number of attempts and the time the last one took
+	def get_upload_attempts():
+		attempts = {}
+		for entry in (status.upload_attempts or '').split(' '):
+			if not entry: continue
+			count, seconds, name = entry.split(':', 2)
+			attempts[name] = (int(count), float(seconds))
+		return attempts
+
+	def set_upload_attempts(attempts):
+		status.upload_attempts = ' '.join('%d:%.1f:%s' % (attempts[name][0], attempts[name][1], name) for name in sorted(attempts))
+
+	# Run the upload command once for each archive, up to options.upload_jobs at a time.
+	# An archive whose upload fails goes back to 'N', so only it is re-sent next time.
+	def upload_separately(indexes):
+		lock = threading.Lock()
+		cmd = options.archive_upload_command.strip()
+
+		def upload(i):
+			start = time.time()
+			try:
+				with tracing.span('upload ' + uploads[i], 'upload') as span:
+					span.add_bytes(os.path.getsize(uploads[i]))
+					support.show_and_run(cmd, [uploads[i]])
+			except SafeException, ex:
+				print "Upload of %s failed: %s" % (uploads[i], ex)
+				ok = False
+			else:
+				ok = True
+			taken = time.time() - start
+			with lock:
+				attempts = get_upload_attempts()
+				count, unused = attempts.get(uploads[i], (0, 0))
+				attempts[uploads[i]] = (count + 1, taken)
+				set_upload_attempts(attempts)
+				if not ok:
+					flags = list(status.verified_uploads)
+					flags[i] = 'N'
+					status.verified_uploads = ''.join(flags)
+				status.save()
+
+		support.parallel_map(upload, indexes, options.upload_jobs)
 
 	# status.verified_uploads is an array of status flags:
 	description = {
@@ -73,8 +149,13 @@ def upload_archives(options, status, uploads):
 
 	while True:
 		print "\nUpload status:"
+		attempts = get_upload_attempts()
 		for i, stat in enumerate(status.verified_uploads):
-			print "- %s : %s" % (uploads[i], description[stat])
+			if uploads[i] in attempts:
+				count, seconds = attempts[uploads[i]]
+				print "- %s : %s (%d attempt(s), last took %.1fs)" % (uploads[i], description[stat], count, seconds)
+			else:
+				print "- %s : %s" % (uploads[i], description[stat])
 		print
 
 		# Break if finished
@@ -97,8 +178,12 @@ def upload_archives(options, status, uploads):
 			status.save()
 
 			# Upload them...
-			if cmd:
-				support.show_and_run(cmd, to_upload)
+			if cmd and options.upload_jobs:
+				upload_separately([i for i in range(len(uploads)) if uploads[i] in to_upload])
+			elif cmd:
+				with tracing.span('upload', 'upload') as span:
+					span.add_bytes(sum(os.path.getsize(x) for x in to_upload))
+					support.show_and_run(cmd, to_upload)
 			else:
 				if len(to_upload) == 1:
 					print "No upload command is set => please upload the archive manually now"
@@ -108,11 +193,12 @@ def upload_archives(options, status, uploads):
 					raw_input('Press Return once the %d archives are uploaded.' % len(to_upload))
 
 		# Verify all Attempted uploads
+		missing = verify_uploads([i for i, stat in enumerate(status.verified_uploads) if stat == 'A'])
 		new_stat = ''
 		for i, stat in enumerate(status.verified_uploads):
-			assert stat in 'AV', status.verified_uploads
+			assert stat in 'NAV', status.verified_uploads
 			if stat == 'A' :
-				if not is_uploaded(url(uploads[i]), os.path.getsize(uploads[i])):
+				if i in missing:
 					print "** Archive '%s' still not uploaded! Try again..." % uploads[i]
 					stat = 'N'
 				else:
@@ -157,6 +243,19 @@ def do_version_substitutions(impl_dir, version_substitutions, new_version):
 			stream.write(new_data)
 
 def do_release(local_feed, options):
+	# Only one release at a time in this directory (e.g. if a batch release is running here)
+	status_lock = support.lock_release_status()
+	try:
+		scm = get_scm(local_feed, options)
+		try:
+			_do_release(local_feed, options, scm)
+		finally:
+			scm.close()
+	finally:
+		if status_lock:
+			status_lock.close()
+
+def _do_release(local_feed, options, scm):
 	if options.master_feed_file or options.archive_dir_public_url or options.archive_upload_command or options.master_feed_upload_command:
 		print(legacy_warning)
 
@@ -211,8 +310,6 @@ def do_release(local_feed, options):
 	else:
 		info("No <release:management> element found in local feed.")
 
-	scm = get_scm(local_feed, options)
-
 	# Path relative to the archive / SCM root
 	local_iface_rel_root_path = local_feed.local_path[len(scm.root_dir) + 1:]
 
@@ -224,14 +321,19 @@ def do_release(local_feed, options):
 			print "[%s]: %s" % (phase, x)
 			support.check_call(x, shell = True, cwd = cwd, env = full_env)
 
+	@tracing.traced('set to release')
 	def set_to_release():
 		print "Snapshot version is " + local_impl.get_version()
 		release_version = options.release_version
 		if release_version is None:
 			suggested = support.suggest_release_version(local_impl.get_version())
-			release_version = raw_input("Version number for new release [%s]: " % suggested)
-			if not release_version:
+			if options.candidate_only:
+				print "Using suggested version number %s" % suggested
 				release_version = suggested
+			else:
+				release_version = raw_input("Version number for new release [%s]: " % suggested)
+				if not release_version:
+					release_version = suggested
 
 		scm.ensure_no_tag(release_version)
 
@@ -254,6 +356,7 @@ def do_release(local_feed, options):
 		status.head_at_release = scm.commit('Release %s' % release_version, branch = TMP_BRANCH_NAME, parent = 'HEAD')
 		status.save()
 
+	@tracing.traced('set to snapshot')
 	def set_to_snapshot(snapshot_version):
 		assert snapshot_version.endswith('-post')
 		support.publish(local_feed.local_path, set_released = '', set_version = snapshot_version)
@@ -262,6 +365,7 @@ def do_release(local_feed, options):
 		status.new_snapshot_version = scm.get_head_revision()
 		status.save()
 
+	@tracing.traced('check ready to release')
 	def ensure_ready_to_release():
 		#if not options.master_feed_file:
 		#	raise SafeException("Master feed file not set! Check your configuration")
@@ -272,12 +376,21 @@ def do_release(local_feed, options):
 		# Not needed for GIT. For SCMs where tagging is expensive (e.g. svn) this might be useful.
 		#run_unit_tests(local_impl)
 
-		scm.grep('\(^\\|[^=]\)\<\\(TODO\\|XXX\\|FIXME\\)\>')
+		previous_release = get_previous_release(status.release_version or local_impl.get_version())
+		notes = scm.grep_changed('\(^\\|[^=]\)\<\\(TODO\\|XXX\\|FIXME\\)\>', previous_release)
+		if notes:
+			print "TODO/XXX/FIXME notes in files changed since %s:" % (previous_release or 'the start')
+			for path in sorted(notes):
+				print "%s (%d):" % (path, len(notes[path]))
+				for line_number, line in notes[path]:
+					print "  %d: %s" % (line_number, line)
+			print "(%d in %d files)\n" % (sum(len(x) for x in notes.values()), len(notes))
 
 		branch = scm.get_current_branch()
 		if branch != "refs/heads/master":
 			print "\nWARNING: you are currently on the '%s' branch.\nThe release will be made from that branch.\n" % branch
 
+	@tracing.traced('create source feed')
 	def create_feed(target_feed, local_iface_path, archive_file, archive_name, main):
 		shutil.copyfile(local_iface_path, target_feed)
 
@@ -290,15 +403,20 @@ def do_release(local_feed, options):
 	def get_previous_release(this_version):
 		"""Return the highest numbered verison in the master feed before this_version.
 		@return: version, or None if there wasn't one"""
-		parsed_release_version = model.parse_version(this_version)
+		return scm.get_version_index().get_previous(this_version)
 
-		versions = [model.parse_version(version) for version in scm.get_tagged_versions()]
-		versions = [version for version in versions if version < parsed_release_version]
+	def get_previous_archive_file(previous_release):
+		previous_archive_name = support.make_archive_name(local_feed.get_name(), previous_release)
+		previous_archive_file = '..' + os.sep + previous_release + os.sep + previous_archive_name + '.tar.bz2'
 
-		if versions:
-			return model.format_version(max(versions))
-		return None
+		# For archives created by older versions of 0release
+		if not os.path.isfile(previous_archive_file):
+			old_previous_archive_file = '..' + os.sep + previous_archive_name + '.tar.bz2'
+			if os.path.isfile(old_previous_archive_file):
+				previous_archive_file = old_previous_archive_file
+		return previous_archive_file
 
+	@tracing.traced('export changelog')
 	def export_changelog(previous_release):
 		changelog = file('changelog-%s' % status.release_version, 'w')
 		try:
@@ -314,21 +432,25 @@ def do_release(local_feed, options):
 	def fail_candidate():
 		cwd = os.getcwd()
 		assert cwd.endswith(status.release_version)
+		support.remove_extraction_cache(archive_file)
 		support.backup_if_exists(cwd)
 		scm.delete_branch(TMP_BRANCH_NAME)
 		os.unlink(support.release_status_file)
 		print "Restored to state before starting release. Make your fixes and try again..."
 
+	@tracing.traced('add to repository (0repo)')
 	def release_via_0repo(new_impls_feed):
 		import repo.cmd
-		support.make_archives_relative(new_impls_feed)
 		oldcwd = os.getcwd()
 		try:
 			repo.cmd.main(['0repo', 'add', '--', new_impls_feed])
 		finally:
 			os.chdir(oldcwd)
 
-	def release_without_0repo(archive_file, new_impls_feed):
+	@tracing.traced('update master feed')
+	def prepare_master_feed(new_impls_feed, signer):
+		"""Add the new implementations to a copy of the master feed and queue it for signing.
+		@return: a function which replaces the master feed with the signed copy, or None if already done"""
 		assert options.master_feed_file
 
 		if not options.archive_dir_public_url:
@@ -336,29 +458,57 @@ def do_release(local_feed, options):
 
 		if status.updated_master_feed:
 			print "Already added to master feed. Not changing."
+			return None
+
+		publish_opts = {}
+		master_feed_path = os.path.realpath(options.master_feed_file)
+		if os.path.exists(master_feed_path):
+			# Check we haven't already released this version
+			master_versions = support.load_feed_versions(master_feed_path)
+			existing_releases = [v for v in master_versions if v[0] == status.release_version]
+			if len(existing_releases):
+				raise SafeException("Master feed %s already contains an implementation with version number %s!" % (options.master_feed_file, status.release_version))
+
+			previous_release = get_previous_release(status.release_version)
+			previous_testing_releases = [v for v in master_versions if v[0] == previous_release and v[1] == 'testing']
+			if previous_testing_releases:
+				print "The previous release, version %s, is still marked as 'testing'. Set to stable?" % previous_release
+				if support.get_choice(['Yes', 'No']) == 'Yes':
+					publish_opts['select_version'] = previous_release
+					publish_opts['set_stability'] = "stable"
 		else:
-			publish_opts = {}
-			if os.path.exists(options.master_feed_file):
-				# Check we haven't already released this version
-				master = support.load_feed(os.path.realpath(options.master_feed_file))
-				existing_releases = [impl for impl in master.implementations.values() if impl.get_version() == status.release_version]
-				if len(existing_releases):
-					raise SafeException("Master feed %s already contains an implementation with version number %s!" % (options.master_feed_file, status.release_version))
-
-				previous_release = get_previous_release(status.release_version)
-				previous_testing_releases = [impl for impl in master.implementations.values() if impl.get_version() == previous_release
-													     and impl.upstream_stability == model.stability_levels["testing"]]
-				if previous_testing_releases:
-					print "The previous release, version %s, is still marked as 'testing'. Set to stable?" % previous_release
-					if support.get_choice(['Yes', 'No']) == 'Yes':
-						publish_opts['select_version'] = previous_release
-						publish_opts['set_stability'] = "stable"
-
-			support.publish(options.master_feed_file, local = new_impls_feed, xmlsign = True, key = options.key, **publish_opts)
+			master_versions = []
+
+		# Work on a copy, so that the master feed is only replaced once it's signed
+		new_master = master_feed_path + '.new'
+		if os.path.exists(master_feed_path):
+			shutil.copyfile(master_feed_path, new_master)
+		elif os.path.exists(new_master):
+			os.unlink(new_master)	# (left over from an interrupted release)
+		support.publish(new_master, local = new_impls_feed, unsign = True, **publish_opts)
+		with open(new_master, 'rb') as stream:
+			data = signing.remove_xml_signature(stream.read())
+		signature = signer.add('master feed ' + options.master_feed_file, data)
+
+		# Keep the index up-to-date, so we don't have to parse the whole feed next time
+		if 'set_stability' in publish_opts:
+			master_versions = [(version, version == previous_release and 'stable' or stability, id)
+						for (version, stability, id) in master_versions]
+		master_versions += support.get_feed_versions(support.load_feed(new_impls_feed))
+
+		def update_master_feed():
+			with open(new_master, 'wb') as stream:
+				stream.write(signing.add_xml_signature(data, signature.get()))
+			portable_rename(new_master, master_feed_path)
+			signing.export_public_key(os.path.dirname(master_feed_path), signature.fingerprint)
+			support.save_feed_versions(master_feed_path, master_versions)
 
 			status.updated_master_feed = 'true'
 			status.save()
+		return update_master_feed
 
+	@tracing.traced('publish')
+	def release_without_0repo(archive_file, new_impls_feed):
 		# Copy files...
 		uploads = [os.path.basename(archive_file)]
 		for b in compiler.get_binary_feeds():
@@ -377,7 +527,12 @@ def do_release(local_feed, options):
 		else:
 			print "NOTE: No feed upload command set => you'll have to upload them yourself!"
 
+	@tracing.traced('accept and publish')
 	def accept_and_publish(archive_file, src_feed_name):
+		# Everything we need to sign is queued here and signed together (see signing.py)
+		signer = signing.Signer(options.key)
+		create_tag = None
+
 		if status.tagged:
 			print "Already tagged in SCM. Not re-tagging."
 		else:
@@ -388,15 +543,13 @@ def do_release(local_feed, options):
 						    "HEAD was " + status.head_before_release + "\n"
 						    "HEAD now " + head)
 
-			scm.tag(status.release_version, status.head_at_release)
-			scm.reset_hard(TMP_BRANCH_NAME)
-			scm.delete_branch(TMP_BRANCH_NAME)
-
-			status.tagged = 'true'
-			status.save()
+			create_tag = scm.queue_tag(status.release_version, status.head_at_release, signer)
 
 		assert len(local_feed.feed_for) == 1
 
+		use_0repo()
+		from repo import registry, merge
+
 		# Merge the source and binary feeds together first, so
 		# that we update the master feed atomically and only
 		# have to sign it once.
@@ -404,16 +557,45 @@ def do_release(local_feed, options):
 			doc = minidom.parse(stream)
 		for b in compiler.get_binary_feeds():
 			with open(b, 'rb') as stream:
-				bin_doc = minidom.parse(b)
+				bin_doc = minidom.parse(stream)
 			merge.merge(doc, bin_doc)
-		new_impls_feed = 'merged.xml'
-		with open(new_impls_feed, 'wb') as stream:
-			doc.writexml(stream)
 
 		# TODO: support uploading to a sub-feed (requires support in 0repo too)
 		master_feed, = local_feed.feed_for
 		repository = registry.lookup(master_feed, missing_ok = True)
+
+		new_impls_feed = 'merged.xml'
+		with open(new_impls_feed, 'wb') as stream:
+			if repository:
+				# 0repo wants relative archive URLs. Fix them while we have
+				# the document, rather than parsing merged.xml again.
+				support.make_doc_archives_relative(doc)
+				doc.writexml(stream)
+				stream.write(b'\n')
+			else:
+				doc.writexml(stream)
+
+		if repository:
+			update_master_feed = None
+		else:
+			update_master_feed = prepare_master_feed(new_impls_feed, signer)
+
+		with tracing.span('sign', 'phase'):
+			signer.sign_all()
+
+		if create_tag:
+			create_tag()
+			scm.reset_hard(TMP_BRANCH_NAME)
+			scm.delete_branch(TMP_BRANCH_NAME)
+
+			status.tagged = 'true'
+			status.save()
+
+		if update_master_feed:
+			update_master_feed()
+
 		if repository:
+			# (0repo signs the feeds itself, using the key in its own configuration)
 			release_via_0repo(new_impls_feed)
 		else:
 			release_without_0repo(archive_file, new_impls_feed)
@@ -427,6 +609,8 @@ def do_release(local_feed, options):
 		else:
 			print "NOTE: No public repository set => you'll have to push the tag and trunk yourself."
 
+		for phase, duration in status.get_timings():
+			info("%8.1fs until %s", duration, phase)
 		os.unlink(support.release_status_file)
 
 	if status.head_before_release:
@@ -484,23 +668,26 @@ def do_release(local_feed, options):
 	if status.created_archive and os.path.isfile(archive_file):
 		print "Archive already created"
 	else:
-		support.backup_if_exists(archive_file)
-		scm.export(export_prefix, archive_file, status.head_at_release)
-
-		has_submodules = scm.has_submodules()
-
-		if phase_actions['generate-archive'] or has_submodules:
-			try:
-				support.unpack_tarball(archive_file)
-				if has_submodules:
-					scm.export_submodules(archive_name)
-				run_hooks('generate-archive', cwd = archive_name, env = {'RELEASE_VERSION': status.release_version})
-				info("Regenerating archive (may have been modified by generate-archive hooks...")
-				support.check_call(['tar', 'cjf', archive_file, archive_name])
-			except SafeException:
-				scm.reset_hard(scm.get_current_branch())
-				fail_candidate()
-				raise
+		with tracing.span('create archive', 'phase'):
+			support.backup_if_exists(archive_file)
+
+			has_submodules = scm.has_submodules()
+
+			if phase_actions['generate-archive'] or has_submodules:
+				# Assemble the tree in archive_name first and only compress it once it's complete
+				scm.export_tree(export_prefix, status.head_at_release)
+				try:
+					if has_submodules:
+						scm.export_submodules(archive_name)
+					run_hooks('generate-archive', cwd = archive_name, env = {'RELEASE_VERSION': status.release_version})
+					info("Creating archive (may have been modified by generate-archive hooks)...")
+					support.make_tarball(archive_file, archive_name, options.jobs)
+				except SafeException:
+					scm.reset_hard(scm.get_current_branch())
+					fail_candidate()
+					raise
+			else:
+				scm.export(export_prefix, archive_file, status.head_at_release)
 
 		status.created_archive = 'true'
 		status.save()
@@ -512,7 +699,7 @@ def do_release(local_feed, options):
 		scm.reset_hard(scm.get_current_branch())
 
 	#backup_if_exists(archive_name)
-	support.unpack_tarball(archive_file)
+	support.unpack_tarball_cached(archive_file)
 
 	extracted_feed_path = os.path.abspath(os.path.join(export_prefix, local_iface_rel_root_path))
 	assert os.path.isfile(extracted_feed_path), "Local feed not in archive! Is it under version control?"
@@ -533,23 +720,35 @@ def do_release(local_feed, options):
 	else:
 		main = None
 
+	previous_release = get_previous_release(status.release_version)
+	if previous_release and not status.tagged:
+		# Compare with the previous release while the tests and builds run
+		previous_archive_file = get_previous_archive_file(previous_release)
+		if os.path.isfile(previous_archive_file):
+			archive_diff = archivediff.BackgroundDiff(previous_archive_file, archive_file)
+
 	try:
 		if status.src_tests_passed:
 			print "Unit-tests already passed - not running again"
 		else:
-			# Make directories read-only (checks tests don't write)
-			support.make_readonly_recursive(archive_name)
+			# The tests shouldn't write to the source tree. Any changes they make are
+			# discarded (so we don't need to unpack it again) and reported.
+			test_sandbox = sandbox.TestSandbox(archive_file, archive_name)
+			try:
+				run_unit_tests(extracted_feed_path, test_sandbox)
+			finally:
+				written = test_sandbox.finish()
+				if written:
+					print "WARNING: the unit-tests wrote to the source tree (these changes have been undone):"
+					for path in written:
+						print "- " + path
 
-			run_unit_tests(extracted_feed_path)
 			status.src_tests_passed = True
 			status.save()
 	except SafeException:
 		print "(leaving extracted directory for examination)"
 		fail_candidate()
 		raise
-	# Unpack it again in case the unit-tests changed anything
-	ro_rmtree(archive_name)
-	support.unpack_tarball(archive_file)
 
 	# Generate feed for source
 	src_feed_name = '%s.xml' % archive_name
@@ -558,14 +757,25 @@ def do_release(local_feed, options):
 
 	# If it's a source package, compile the binaries now...
 	compiler = compile.Compiler(options, os.path.abspath(src_feed_name), release_version = status.release_version)
-	compiler.build_binaries()
+	with tracing.span('build binaries', 'phase'):
+		compiler.build_binaries()
 
-	previous_release = get_previous_release(status.release_version)
 	export_changelog(previous_release)
 
+	if options.candidate_only:
+		print "\nCandidate release archive:", archive_file
+		print "Stopping before the review (run again to publish or fail it)"
+		return
+
 	if status.tagged:
-		raw_input('Already tagged. Press Return to resume publishing process...')
+		if options.review_choice == 'Fail':
+			raise SafeException("Already tagged; can't fail the candidate now")
+		if not options.review_choice:
+			raw_input('Already tagged. Press Return to resume publishing process...')
 		choice = 'Publish'
+	elif options.review_choice:
+		choice = options.review_choice
+		print "\nCandidate release archive %s: %s (from the command line)" % (archive_file, choice)
 	else:
 		print "\nCandidate release archive:", archive_file
 		print "(extracted to %s for inspection)" % os.path.abspath(archive_name)
@@ -583,21 +793,8 @@ def do_release(local_feed, options):
 		while True:
 			choice = support.get_choice(['Publish', 'Fail'] + maybe_diff)
 			if choice == 'Diff':
-				previous_archive_name = support.make_archive_name(local_feed.get_name(), previous_release)
-				previous_archive_file = '..' + os.sep + previous_release + os.sep + previous_archive_name + '.tar.bz2'
-
-				# For archives created by older versions of 0release
-				if not os.path.isfile(previous_archive_file):
-					old_previous_archive_file = '..' + os.sep + previous_archive_name + '.tar.bz2'
-					if os.path.isfile(old_previous_archive_file):
-						previous_archive_file = old_previous_archive_file
-
 				if os.path.isfile(previous_archive_file):
-					support.unpack_tarball(previous_archive_file)
-					try:
-						support.show_diff(previous_archive_name, archive_name)
-					finally:
-						shutil.rmtree(previous_archive_name)
+					archivediff.show_diff(previous_archive_file, archive_file, archive_diff.get())
 				else:
 					# TODO: download it?
 					print "Sorry, archive file %s not found! Can't show diff." % previous_archive_file
@@ -608,6 +805,7 @@ def do_release(local_feed, options):
 	shutil.rmtree(archive_name)
 
 	if choice == 'Publish':
+		support.remove_extraction_cache(archive_file)
 		accept_and_publish(archive_file, src_feed_name)
 	else:
 		assert choice == 'Fail'
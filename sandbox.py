@@ -0,0 +1,147 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Run the unit-tests without letting them change the extracted release candidate,
+# and find out whether they tried to.
+#
+# Where we can (Linux, with unprivileged user namespaces and overlayfs), the tests
+# see an overlay of the pristine tree from the extraction cache, mounted over the
+# extracted directory in a private mount namespace. Their writes go to a scratch
+# directory, which tells us exactly what they wrote, and the extracted directory
+# itself is never touched.
+#
+# Otherwise, the tests run on the extracted directory (a copy of the pristine tree).
+# We record the size, mtime and ctime of everything in it first, and afterwards
+# restore just the files that changed. A test can set a file's mtime back, but not
+# its ctime, so this catches every write.
+
+import os, stat, shutil, tempfile, subprocess
+from logging import info
+
+from zeroinstall.support import ro_rmtree
+
+import support
+
+_overlay_supported = None
+
+def _overlay_command(lower, upper, work, target, command):
+	# Mount the overlay as root in a new user namespace, then run command in a
+	# nested namespace as our real uid/gid (so the tests don't think they're root)
+	script = 'mount -t overlay overlay -o "lowerdir=$1,upperdir=$2,workdir=$3" "$4" && shift 4 && exec unshare --user --map-user=%d --map-group=%d "$@"' % (os.getuid(), os.getgid())
+	return ['unshare', '--user', '--map-root-user', '--mount', 'sh', '-c', script, 'sh', lower, upper, work, target] + command
+
+def overlay_supported():
+	"""Check (once) whether we can use an overlay mount."""
+	global _overlay_supported
+	if _overlay_supported is None:
+		_overlay_supported = False
+		if support.in_PATH('unshare'):
+			tmp = tempfile.mkdtemp(prefix = '0release-')
+			try:
+				dirs = [os.path.join(tmp, name) for name in ['lower', 'upper', 'work', 'merged']]
+				for d in dirs:
+					os.mkdir(d)
+				with open(os.devnull, 'w') as devnull:
+					code = subprocess.call(_overlay_command(*(dirs + [['true']])), stdout = devnull, stderr = devnull)
+				_overlay_supported = code == 0
+			except OSError, ex:
+				info("Can't check for overlay support: %s", ex)
+			finally:
+				ro_rmtree(tmp)
+		info("Overlay test sandbox available: %s", _overlay_supported)
+	return _overlay_supported
+
+def _snapshot(tree):
+	"""@return: a dict mapping the path (relative to tree) of everything in tree to its lstat details"""
+	snapshot = {}
+	def scan(rel):
+		for name in os.listdir(os.path.join(tree, rel)):
+			path = os.path.join(rel, name)
+			info = os.lstat(os.path.join(tree, path))
+			if stat.S_ISDIR(info.st_mode):
+				# (adding or removing entries changes a directory's times; we see those separately)
+				snapshot[path] = (info.st_mode,)
+				scan(path)
+			else:
+				snapshot[path] = (info.st_mode, info.st_size, info.st_mtime, info.st_ctime)
+	scan('')
+	return snapshot
+
+def _compare_snapshots(before, after):
+	"""@return: the paths which were added, removed or changed between the two snapshots.
+	If a directory was added or removed, only the directory itself is listed."""
+	changed = set(path for path in set(before) | set(after) if before.get(path, None) != after.get(path, None))
+	def parent_changed(path):
+		parent = os.path.dirname(path)
+		while parent:
+			if parent in changed:
+				return True
+			parent = os.path.dirname(parent)
+		return False
+	return sorted(path for path in changed if not parent_changed(path))
+
+def _list_upper(upper, lower, rel = ''):
+	# Everything in an overlay's upper directory was written (or deleted: a whiteout)
+	# except for directories that exist in lower, which may just contain written files
+	written = []
+	for name in sorted(os.listdir(os.path.join(upper, rel))):
+		path = os.path.join(rel, name)
+		full = os.path.join(upper, path)
+		if os.path.isdir(full) and not os.path.islink(full) and os.path.isdir(os.path.join(lower, path)):
+			written += _list_upper(upper, lower, path)
+		else:
+			written.append(path)
+	return written
+
+def _remove(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		ro_rmtree(path)
+	elif os.path.lexists(path):
+		os.unlink(path)
+
+class TestSandbox:
+	def __init__(self, archive_file, tree_dir):
+		"""@param tree_dir: the directory where archive_file has been extracted (a copy of the pristine tree)"""
+		self.tree_dir = os.path.abspath(tree_dir)
+		self.pristine = os.path.join(support.get_pristine_tree(archive_file), os.path.basename(self.tree_dir))
+		assert os.path.isdir(self.pristine), self.pristine
+		self.scratch = None
+		self.snapshot = None
+		if overlay_supported():
+			self.scratch = tempfile.mkdtemp(prefix = '.0release-sandbox-', dir = os.path.dirname(self.tree_dir))
+			os.mkdir(os.path.join(self.scratch, 'upper'))
+			os.mkdir(os.path.join(self.scratch, 'work'))
+		else:
+			self.snapshot = _snapshot(self.tree_dir)
+
+	def wrap(self, command):
+		"""Return the command to use to run command in the sandbox."""
+		if self.scratch is None:
+			return command
+		return _overlay_command(self.pristine, os.path.join(self.scratch, 'upper'), os.path.join(self.scratch, 'work'),
+					self.tree_dir, command)
+
+	def finish(self):
+		"""Discard any changes made to the tree.
+		@return: the paths (relative to the tree) that were written, created or deleted"""
+		if self.scratch is not None:
+			try:
+				return _list_upper(os.path.join(self.scratch, 'upper'), self.pristine)
+			finally:
+				ro_rmtree(self.scratch)
+				self.scratch = None
+
+		written = _compare_snapshots(self.snapshot, _snapshot(self.tree_dir))
+		for path in written:
+			info("Restoring %s", path)
+			target = os.path.join(self.tree_dir, path)
+			source = os.path.join(self.pristine, path)
+			_remove(target)
+			if os.path.isdir(source) and not os.path.islink(source):
+				shutil.copytree(source, target, symlinks = True)
+			elif os.path.lexists(source):
+				if os.path.islink(source):
+					os.symlink(os.readlink(source), target)
+				else:
+					shutil.copy2(source, target)
+		return written
@@ -1,10 +1,12 @@
 # Copyright (C) 2007, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import os, subprocess, tempfile
+import os, subprocess, threading, json, hashlib
 from zeroinstall import SafeException
+from zeroinstall.support import basedir, portable_rename
 from logging import info, warn
-from support import unpack_tarball
+import tracing
+from support import unpack_tar_stream, write_compressed, parallel_map, VersionIndex
 
 class SCM:
 	def __init__(self, root_dir, options):
@@ -12,10 +14,67 @@ class SCM:
 		self.root_dir = root_dir
 		assert type(root_dir) == str, root_dir
 
+	def close(self):
+		"""Stop any helper processes."""
+		pass
+
+def _latin1(s):
+	# (we store the lines from git grep in JSON as latin-1, so that any bytes can be round-tripped)
+	if isinstance(s, unicode):
+		return s.encode('latin-1')
+	return s
+
+class _BatchCheck:
+	"""A long-running "git cat-file --batch-check", so that we can look up
+	several objects without starting a new git process each time."""
+	def __init__(self, git):
+		self.git = git
+		self.child = None
+		self.lock = threading.Lock()
+
+	def lookup(self, name):
+		"""Resolve name (e.g. "HEAD" or "HEAD:path") to an object.
+		@return: (sha1, type), or None if it doesn't exist"""
+		assert '\n' not in name, name
+		with self.lock:
+			if self.child is None:
+				self.child = self.git._run(['cat-file', '--batch-check'], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+			self.child.stdin.write(name + '\n')
+			self.child.stdin.flush()
+			line = self.child.stdout.readline()
+		if not line:
+			raise SafeException("git cat-file --batch-check exited unexpectedly")
+		parts = line.split()
+		if parts[-1] == 'missing':
+			return None
+		return parts[0], parts[1]
+
+	def close(self):
+		with self.lock:
+			if self.child is not None:
+				self.child.stdin.close()
+				self.child.wait()
+				self.child = None
+
 class GIT(SCM):
+	_batch = None
+	_current_branch = None
+	_tagged_versions = None
+	_version_index = None
+
+	def _lookup(self, name):
+		if self._batch is None:
+			self._batch = _BatchCheck(self)
+		return self._batch.lookup(name)
+
+	def close(self):
+		if self._batch is not None:
+			self._batch.close()
+			self._batch = None
+
 	def _run(self, args, **kwargs):
 		info("Running git %s (in %s)", ' '.join(args), self.root_dir)
-		return subprocess.Popen(["git"] + args, cwd = self.root_dir, **kwargs)
+		return tracing.Popen(["git"] + args, cwd = self.root_dir, category = 'git', **kwargs)
 
 	def _run_check(self, args, **kwargs):
 		child = self._run(args, **kwargs)
@@ -23,17 +82,21 @@ class GIT(SCM):
 		if code:
 			raise SafeException("Git %s failed with exit code %d" % (repr(args), code))
 
-	def _run_stdout(self, args, **kwargs):
+	def _run_stdout(self, args, allow_fail = False, **kwargs):
 		child = self._run(args, stdout = subprocess.PIPE, **kwargs)
 		stdout, unused = child.communicate()
-		if child.returncode:
+		if child.returncode and not allow_fail:
 			raise SafeException('Failed to get current branch! Exit code %d: %s' % (child.returncode, stdout))
 		return stdout
 
 	def ensure_versioned(self, path):
 		"""Ensure path is a file tracked by the version control system.
 		@raise SafeException: if file is not tracked"""
-		out = self._run_stdout(['ls-tree', 'HEAD', path]).strip()
+		rel_path = os.path.relpath(path, self.root_dir)
+		if rel_path.startswith('..'):
+			out = self._run_stdout(['ls-tree', 'HEAD', path]).strip()
+		else:
+			out = self._lookup('HEAD:' + rel_path.replace(os.sep, '/'))
 		if not out:
 			raise SafeException("File '%s' is not under version control, according to git-ls-tree" % path)
 
@@ -69,27 +132,83 @@ class GIT(SCM):
 	def make_tag(self, version):
 		return 'v' + version
 
-	def tag(self, version, revision):
+	def queue_tag(self, version, revision, signer):
+		"""Prepare a signed tag for revision. The signature is made by signer (along with
+		the release's other signatures). Call the returned function after signer.sign_all to create the tag."""
 		tag = self.make_tag(version)
 		if self.options.key:
-			key_opts = ['-u', self.options.key]
+			key = self.options.key
 		else:
-			key_opts = []
-		self._run_check(['tag', '-s'] + key_opts + ['-m', 'Release %s' % version, tag, revision])
-		print "Tagged as %s" % tag
+			# (the key "git tag -s" would use)
+			key = self._run_stdout(['config', '--get', 'user.signingkey'], allow_fail = True).strip() or \
+				self._run_stdout(['var', 'GIT_COMMITTER_IDENT']).strip().rsplit('>', 1)[0] + '>'
+		tagger = self._run_stdout(['var', 'GIT_COMMITTER_IDENT']).strip()
+		obj = self._run_stdout(['rev-parse', '--verify', revision + '^{commit}']).strip()
+		tag_data = 'object %s\ntype commit\ntag %s\ntagger %s\n\nRelease %s\n' % (obj, tag, tagger, version)
+		signature = signer.add('tag ' + tag, tag_data, armor = True, key = key)
+
+		def create_tag():
+			child = self._run(['mktag'], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+			tag_obj, unused = child.communicate(tag_data + signature.get())
+			if child.returncode:
+				raise SafeException("git mktag failed with exit code %d" % child.returncode)
+			self._run_check(['update-ref', 'refs/tags/' + tag, tag_obj.strip(), ''])
+			self._tagged_versions = None
+			self._version_index = None
+			print "Tagged as %s" % tag
+		return create_tag
 
 	def get_current_branch(self):
-		current_branch = self._run_stdout(['symbolic-ref', 'HEAD']).strip()
-		info("Current branch is %s", current_branch)
-		return current_branch
+		# (we never switch branches, so this can't change during a run)
+		if self._current_branch is None:
+			self._current_branch = self._run_stdout(['symbolic-ref', 'HEAD']).strip()
+			info("Current branch is %s", self._current_branch)
+		return self._current_branch
 
 	def get_tagged_versions(self):
-		child = self._run(['tag', '-l', 'v*'], stdout = subprocess.PIPE)
-		stdout, unused = child.communicate()
-		status = child.wait()
-		if status:
-			raise SafeException("git tag failed with exit code %d" % status)
-		return [v[1:] for v in stdout.split('\n') if v]
+		if self._tagged_versions is None:
+			child = self._run(['tag', '-l', 'v*'], stdout = subprocess.PIPE)
+			stdout, unused = child.communicate()
+			status = child.wait()
+			if status:
+				raise SafeException("git tag failed with exit code %d" % status)
+			self._tagged_versions = [v[1:] for v in stdout.split('\n') if v]
+		return self._tagged_versions[:]
+
+	def _get_tags_key(self):
+		# Changes whenever a tag is added or removed (None if we can't tell)
+		git_dir = os.path.join(self.root_dir, '.git')
+		if not os.path.isdir(git_dir):
+			return None
+		key = []
+		for path in [os.path.join(git_dir, 'packed-refs'), os.path.join(git_dir, 'refs', 'tags')]:
+			if os.path.exists(path):
+				st = os.stat(path)
+				key.append([path, st.st_mtime, st.st_size])
+		return key
+
+	def get_version_index(self):
+		"""Get the tagged versions as a sorted index. This is cached between
+		runs until a tag is added or removed."""
+		if self._version_index is None:
+			key = json.loads(json.dumps(self._get_tags_key()))	# (so it compares equal to the saved copy)
+			cache = os.path.join(basedir.save_cache_path('0install.net', '0release'),
+					'tags-' + hashlib.sha1(self.root_dir).hexdigest())
+			if key is not None and os.path.exists(cache):
+				try:
+					with open(cache) as stream:
+						self._version_index = VersionIndex.load(stream, key)
+				except Exception, ex:
+					warn("Failed to load tags cache %s: %s", cache, ex)
+			if self._version_index is None:
+				self._version_index = VersionIndex(self.get_tagged_versions())
+				if key is not None:
+					with open(cache + '.new', 'w') as stream:
+						self._version_index.save(stream, key)
+					portable_rename(cache + '.new', cache)
+			else:
+				info("Loaded tagged versions from %s", cache)
+		return self._version_index
 
 	def delete_branch(self, branch):
 		self._run_check(['branch', '-D', branch])
@@ -99,34 +218,42 @@ class GIT(SCM):
 
 	def ensure_no_tag(self, version):
 		tag = self.make_tag(version)
-		child = self._run(['tag', '-l', tag], stdout = subprocess.PIPE)
-		stdout, unused = child.communicate()
-		if tag in stdout.split('\n'):
+		if self._lookup('refs/tags/' + tag):
 			raise SafeException(("Release %s is already tagged! If you want to replace it, do\n" + 
 						"git tag -d %s") % (version, tag))
 
 	def export(self, prefix, archive_file, revision):
 		child = self._run(['archive', '--format=tar', '--prefix=' + prefix + os.sep, revision], stdout = subprocess.PIPE)
-		subprocess.check_call(['bzip2', '-'], stdin = child.stdout, stdout = file(archive_file, 'w'))
-		status = child.wait()
+		status = write_compressed(child, archive_file, self.options.jobs)
 		if status:
 			if os.path.exists(archive_file):
 				os.unlink(archive_file)
 			raise SafeException("git-archive failed with exit code %d" % status)
 
+	def export_tree(self, prefix, revision):
+		"""Extract revision under prefix in the current directory (without compressing it)."""
+		self._export_tar(['--prefix=' + prefix + os.sep, revision], '.')
+
+	def export_tree_to(self, target_dir, revision):
+		"""Extract revision into target_dir."""
+		self._export_tar([revision], target_dir)
+
+	def _export_tar(self, args, target_dir):
+		child = self._run(['archive', '--format=tar'] + args, stdout = subprocess.PIPE)
+		try:
+			unpack_tar_stream(child.stdout, target_dir)
+		finally:
+			child.stdout.close()
+			status = child.wait()
+		if status:
+			raise SafeException("git-archive failed with exit code %d" % status)
+
 	def export_submodules(self, target):
-		# Export all sub-modules under target
-		cwd = os.getcwd()
+		# Export all sub-modules under target, several at once
 		target = os.path.abspath(target)
-		for scm in self._submodules():
-			tmp = tempfile.NamedTemporaryFile(prefix = '0release-')
-			try:
-				scm.export(prefix = '.', archive_file = tmp.name, revision = scm.rev)
-				os.chdir(os.path.join(target, scm.rel_path))
-				unpack_tarball(tmp.name)
-			finally:
-				tmp.close()
-		os.chdir(cwd)
+		def export(scm):
+			scm.export_tree_to(os.path.join(target, scm.rel_path), scm.rev)
+		parallel_map(export, list(self._submodules()), self.options.jobs)
 
 	def commit(self, message, branch, parent):
 		self._run_check(['add', '-u'])		# Commit all changed tracked files to index
@@ -139,13 +266,12 @@ class GIT(SCM):
 		return commit
 
 	def get_head_revision(self):
-		proc = self._run(['rev-parse', 'HEAD'], stdout = subprocess.PIPE)
-		stdout, unused = proc.communicate()
-		if proc.returncode:
-			raise Exception("git rev-parse failed with exit code %d" % proc.returncode)
-		head = stdout.strip()
-		assert head
-		return head
+		head = self._lookup('HEAD')
+		if head is None:
+			raise Exception("Can't resolve HEAD")
+		sha1, type = head
+		assert type == 'commit', head
+		return sha1
 
 	def export_changelog(self, last_release_version, head, stream):
 		if last_release_version:
@@ -160,6 +286,65 @@ class GIT(SCM):
 			return
 		warn("git grep returned exit code %d", child.returncode)
 
+	def grep_changed(self, pattern, since_version):
+		"""Search the files that have changed since the since_version tag (or all files,
+		if None) at HEAD for pattern. The results for each blob are cached, so we only
+		search files which have changed since the last time we were run.
+		@return: a dict mapping paths to lists of (line-number, line) matches"""
+		blobs = {}		# path -> sha1
+		for entry in self._run_stdout(['ls-tree', '-r', '-z', 'HEAD']).split('\0'):
+			if not entry: continue
+			details, path = entry.split('\t', 1)
+			mode, type, sha1 = details.split(' ')
+			if type == 'blob':
+				blobs[path] = sha1
+
+		if since_version:
+			changed = self._run_stdout(['diff', '--name-only', '-z', 'refs/tags/' + self.make_tag(since_version), 'HEAD']).split('\0')
+			blobs = dict((path, blobs[path]) for path in changed if path in blobs)
+
+		# (one cache per repository, since we prune it to the blobs in this one below)
+		cache_file = os.path.join(basedir.save_cache_path('0install.net', '0release'),
+				'grep-' + hashlib.sha1(self.root_dir + '\0' + pattern).hexdigest())
+		try:
+			with open(cache_file) as stream:
+				cache = json.load(stream, encoding = 'latin-1')
+		except (IOError, ValueError):
+			cache = {}
+
+		# Search each new blob once, using any one of the paths with that content
+		new_blobs = dict((sha1, path) for path, sha1 in blobs.iteritems() if sha1 not in cache)
+		to_search = sorted(new_blobs.values())
+		info("Searching %d of %d files (others are cached)", len(to_search), len(blobs))
+
+		def search(paths):
+			child = self._run(['--literal-pathspecs', 'grep', '-n', '-I', '-z', '-e', pattern, 'HEAD', '--'] + paths, stdout = subprocess.PIPE)
+			stdout, unused = child.communicate()
+			if child.returncode not in [0, 1]:
+				raise SafeException("git grep failed with exit code %d" % child.returncode)
+			return stdout
+		chunks = [to_search[i:i + 500] for i in range(0, len(to_search), 500)]
+		found = dict((sha1, []) for sha1 in new_blobs)
+		for output in parallel_map(search, chunks, self.options.jobs):
+			for line in output.split('\n'):
+				if not line: continue
+				path, line_number, text = line.split('\0', 2)
+				assert path.startswith('HEAD:'), path
+				found[blobs[path[5:]]].append((int(line_number), text))
+		cache.update(found)
+
+		results = {}
+		for path, sha1 in blobs.iteritems():
+			if cache[sha1]:
+				results[path] = [(n, _latin1(match)) for n, match in cache[sha1]]
+
+		# Only keep entries for the blobs we're interested in, so the cache doesn't grow forever
+		with open(cache_file + '.new', 'w') as stream:
+			json.dump(dict((sha1, cache[sha1]) for sha1 in blobs.itervalues()), stream, encoding = 'latin-1')
+		portable_rename(cache_file + '.new', cache_file)
+
+		return results
+
 	def has_submodules(self):
 		return os.path.isfile(os.path.join(self.root_dir, '.gitmodules'))
 
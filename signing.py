@@ -0,0 +1,110 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Collect all the signatures a release needs and make them together, one
+# "gpg --detach-sign" after another, rather than each at a different point in the
+# release. (Whether the passphrase is asked for once is up to gpg-agent's cache.)
+
+import os, subprocess, time, base64, tempfile
+from logging import info
+
+from zeroinstall import SafeException
+
+class Signature:
+	"""A signature queued with Signer.add."""
+	def __init__(self, description, data, armor, key):
+		self.description = description
+		self.data = data
+		self.armor = armor
+		self.key = key
+		self.signature = None
+		self.fingerprint = None		# Of the key that made it
+
+	def get(self):
+		"""@return: the detached signature (once Signer.sign_all has been called)"""
+		assert self.signature is not None, "%s not signed yet!" % self.description
+		return self.signature
+
+class Signer:
+	def __init__(self, key):
+		"""@param key: the key to sign with (None to use gpg's default key)"""
+		self.key = key
+		self.pending = []
+
+	def add(self, description, data, armor = False, key = None):
+		"""Queue data for signing. Call sign_all to sign everything queued.
+		@param key: the key to use for this signature, if different from self.key
+		@rtype: L{Signature}"""
+		signature = Signature(description, data, armor, key or self.key)
+		self.pending.append(signature)
+		return signature
+
+	def sign_all(self):
+		"""Sign everything queued with add."""
+		if not self.pending: return
+		print "Signing %d item(s)..." % len(self.pending)
+		total = time.time()
+		while self.pending:
+			signature = self.pending.pop(0)
+			start = time.time()
+			signature.signature, signature.fingerprint = sign_detached(signature.data, signature.key, signature.armor)
+			info("Signed %s in %.2fs", signature.description, time.time() - start)
+		info("All signatures done in %.2fs", time.time() - total)
+
+def sign_detached(data, key, armor = False):
+	"""Make a detached signature for data using gpg.
+	@return: (signature, fingerprint), where the signature is ASCII-armored if armor is set
+	and fingerprint is that of the key which made it"""
+	fd, status_file = tempfile.mkstemp(prefix = '0release-gpg-')
+	os.close(fd)
+	try:
+		args = ['gpg', '--detach-sign', '--use-agent', '--status-file', status_file]
+		if key:
+			args += ['--local-user', key]
+		if armor:
+			args += ['--armor']
+		child = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+		signature, unused = child.communicate(data)
+		if child.returncode:
+			raise SafeException("gpg failed with exit code %d: %s" % (child.returncode, ' '.join(args)))
+		with open(status_file) as stream:
+			# [GNUPG:] SIG_CREATED type pk-algo hash-algo class timestamp fingerprint
+			created = [line.split() for line in stream if line.startswith('[GNUPG:] SIG_CREATED ')]
+	finally:
+		os.unlink(status_file)
+	if len(created) != 1:
+		raise SafeException("Can't find the signing key's fingerprint in gpg's output")
+	return signature, created[0][-1]
+
+def export_public_key(directory, fingerprint):
+	"""Save the public key as KEYID.gpg in directory (as "0publish --xmlsign" did),
+	so it can be uploaded with the feed. Does nothing if the file already exists."""
+	child = subprocess.Popen(['gpg', '--with-colons', '--list-keys', fingerprint], stdout = subprocess.PIPE)
+	stdout, unused = child.communicate()
+	if child.returncode:
+		raise SafeException("gpg --list-keys failed with exit code %d" % child.returncode)
+	key_ids = [line.split(':')[4] for line in stdout.split('\n') if line.startswith('pub:')]
+	if len(key_ids) != 1:
+		raise SafeException("Expected one key with fingerprint %s, but gpg listed %d" % (fingerprint, len(key_ids)))
+	key_file = os.path.join(directory, key_ids[0] + '.gpg')
+	if os.path.isfile(key_file):
+		return
+	child = subprocess.Popen(['gpg', '--armor', '--export', fingerprint], stdout = subprocess.PIPE)
+	exported, unused = child.communicate()
+	if child.returncode or not exported:
+		raise SafeException("Failed to export public key %s" % fingerprint)
+	with open(key_file, 'w') as stream:
+		stream.write(exported)
+	print "Exported public key as '%s'" % key_file
+
+def remove_xml_signature(data):
+	"""Strip any existing signature block from the end of a feed."""
+	index = data.rfind('\n<!-- Base64 Signature')
+	if index == -1:
+		return data
+	return data[:index + 1]
+
+def add_xml_signature(data, signature):
+	"""Append a binary detached signature to data, in the format used by 0install feeds."""
+	assert data.endswith('\n')
+	return data + '<!-- Base64 Signature\n' + base64.encodestring(signature) + '\n-->\n'
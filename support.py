@@ -1,20 +1,26 @@
 # Copyright (C) 2007, Thomas Leonard
 # See the README file for details, or visit http://0install.net.
 
-import copy
-import os, subprocess, tarfile, platform
-import urlparse, ftplib, httplib
-from xml.dom import minidom
+# (tarfile, minidom and the networking modules are imported when needed, as
+# build slaves and the setup command don't use them; see tests/teststartup.py)
+import os, sys, subprocess, platform, bz2, shutil, hashlib, tempfile, time
+import threading, bisect, json, urlparse
 
 from zeroinstall import SafeException
 from zeroinstall.injector import model, qdom, namespaces
 from zeroinstall.support import ro_rmtree, portable_rename
-from logging import info
+from logging import info, warn
+
+import compress, tracing
 
 release_status_file = os.path.abspath('release-status')
+release_lock_file = release_status_file + '.lock'
+
+# Pristine copies of extracted archives, in the same directory as the archive
+extraction_cache_dir = '.0release-extracted'
 
 def check_call(*args, **kwargs):
-	exitstatus = subprocess.call(*args, **kwargs)
+	exitstatus = tracing.Popen(*args, **kwargs).wait()
 	if exitstatus != 0:
 		if type(args[0]) in (str, unicode):
 			cmd = args[0]
@@ -22,9 +28,43 @@ def check_call(*args, **kwargs):
 			cmd = ' '.join(args[0])
 		raise SafeException("Command failed with exit code %d:\n%s" % (exitstatus, cmd))
 
-def show_and_run(cmd, args):
+def parallel_map(fn, items, jobs = None):
+	"""Call fn(item) for each item, using up to jobs threads at once (default: one per CPU).
+	All the calls are allowed to finish; if any of them failed, the first exception is then re-raised.
+	@return: the results, in the same order as items"""
+	items = list(items)
+	if jobs is None:
+		import multiprocessing
+		jobs = multiprocessing.cpu_count()
+	results = [None] * len(items)
+	errors = [None] * len(items)
+	todo = iter(range(len(items)))
+	lock = threading.Lock()
+
+	def worker():
+		while True:
+			with lock:
+				i = next(todo, None)
+			if i is None: return
+			try:
+				results[i] = fn(items[i])
+			except:
+				errors[i] = sys.exc_info()
+
+	threads = [threading.Thread(target = worker) for i in range(min(jobs, len(items)))]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+	for error in errors:
+		if error:
+			raise error[0], error[1], error[2]
+	return results
+
+def show_and_run(cmd, args, **kwargs):
 	print "Executing: %s %s" % (cmd, ' '.join("[%s]" % x for x in args))
-	check_call(['sh', '-c', cmd, '-'] + args)
+	check_call(['sh', '-c', cmd, '-'] + args, **kwargs)
 
 def suggest_release_version(snapshot_version):
 	"""Given a snapshot version, suggest a suitable release version.
@@ -47,7 +87,20 @@ def suggest_release_version(snapshot_version):
 	version[-1] = 0	# Remove the modifier
 	return model.format_version(version)
 
+# The publish options that feededit can handle without running 0publish
+_in_process_options = set(['set_version', 'set_released', 'set_main', 'set_stability', 'select_version',
+			   'archive_url', 'archive_file', 'archive_extract'])
+
 def publish(feed_path, **kwargs):
+	"""Edit the feed at feed_path. Each keyword argument corresponds to a 0publish option.
+	Local edits are done in-process (see edit_feed); anything else runs 0publish.
+	Set $0RELEASE_USE_0PUBLISH to always use 0publish."""
+	options = set(k for k in kwargs if kwargs[k] is not None)
+	if options <= _in_process_options and not os.environ.get('0RELEASE_USE_0PUBLISH', None):
+		if kwargs.get('archive_file') or not kwargs.get('archive_url'):
+			edit_feed(feed_path, **kwargs)
+			return
+
 	args = [os.environ['0PUBLISH']]
 	for k in kwargs:
 		value = kwargs[k] 
@@ -62,6 +115,30 @@ def publish(feed_path, **kwargs):
 	info("Executing %s", args)
 	check_call(args)
 
+def edit_feed(feed_path, set_version = None, set_released = None, set_main = None,
+		set_stability = None, select_version = None,
+		archive_url = None, archive_file = None, archive_extract = None):
+	"""Apply all the given changes to feed_path with a single parse and write."""
+	import feededit
+	info("Editing %s", feed_path)
+	editor = feededit.FeedEditor(feed_path)
+	if set_version is not None:
+		editor.set_version(set_version)
+	if set_released is not None:
+		editor.set_released(set_released)
+	if set_main is not None:
+		editor.set_main(set_main)
+	if set_stability is not None:
+		assert select_version, "set_stability needs select_version"
+		editor.set_stability(set_stability, select_version)
+	if archive_url is not None:
+		# We've usually extracted this archive already, so this doesn't unpack it again
+		tree = get_pristine_tree(archive_file)
+		impl_dir = os.path.join(tree, archive_extract) if archive_extract else tree
+		digests = (feededit.get_manifest_digest(impl_dir, 'sha1new'), feededit.get_manifest_digest(impl_dir, 'sha256new'))
+		editor.add_archive(archive_url, os.path.getsize(archive_file), archive_extract, digests)
+	editor.save()
+
 def get_singleton_impl(feed):
 	impls = feed.implementations
 	if len(impls) != 1:
@@ -106,33 +183,84 @@ def show_diff(from_dir, to_dir):
 				print "WARNING: command %s failed with exit code %d" % (cmd, code)
 			return
 
+def lock_release_status():
+	"""Make sure no other release is running in this directory (e.g. from a batch release).
+	The lock is held until the returned file is closed (or we exit).
+	@return: the open lock file, or None if locking isn't supported here"""
+	try:
+		import fcntl
+	except ImportError:
+		return None
+	stream = open(release_lock_file, 'w')
+	try:
+		fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except IOError:
+		stream.close()
+		raise SafeException("Another release is already running in %s" % os.path.dirname(release_lock_file))
+	return stream
+
+# (Python 2 has no time.monotonic)
+_monotonic = getattr(time, 'monotonic', time.time)
+
 class Status(object):
-	__slots__ = ['old_snapshot_version', 'release_version', 'head_before_release', 'new_snapshot_version',
-		     'head_at_release', 'created_archive', 'src_tests_passed', 'tagged', 'verified_uploads', 'updated_master_feed']
-	def __init__(self):
-		for name in self.__slots__:
+	"""The state of the release in progress, stored in release_status_file (or path).
+	The file is a journal, so saving is just an append: each save adds a "name=value"
+	line for each field that changed (later lines override earlier ones) and then a
+	"#" line giving the time and how long it has been since the previous save
+	(i.e. how long the phase that just finished took)."""
+	fields = ['old_snapshot_version', 'release_version', 'head_before_release', 'new_snapshot_version',
+		  'head_at_release', 'created_archive', 'src_tests_passed', 'tagged', 'verified_uploads', 'upload_attempts',
+		  'updated_master_feed']
+	__slots__ = fields + ['_path', '_saved', '_last_save']
+
+	def __init__(self, path = release_status_file):
+		self._path = path
+		for name in self.fields:
 			setattr(self, name, None)
 
-		if os.path.isfile(release_status_file):
-			for line in file(release_status_file):
-				assert line.endswith('\n')
+		if os.path.isfile(self._path):
+			with open(self._path, 'r+') as stream:
+				data = stream.read()
+				if not data.endswith('\n') and data:
+					# The last save was interrupted part-way through a line. Drop it, so that
+					# the next save doesn't get appended to it.
+					complete = data.rfind('\n') + 1
+					warn("Ignoring incomplete last line in %s: %r", self._path, data[complete:])
+					data = data[:complete]
+					stream.truncate(complete)
+			for line in data.splitlines(True):
+				if line.startswith('#'): continue
 				line = line[:-1]
-				name, value = line.split('=')
-				setattr(self, name, value)
+				name, value = line.split('=', 1)
+				setattr(self, name, value or None)
 				info("Loaded status %s=%s", name, value)
 
+		self._saved = dict((name, getattr(self, name)) for name in self.fields)
+		self._last_save = _monotonic()
+
 	def save(self):
-		tmp_name = release_status_file + '.new'
-		tmp = file(tmp_name, 'w')
-		try:
-			lines = ["%s=%s\n" % (name, getattr(self, name)) for name in self.__slots__ if getattr(self, name)]
-			tmp.write(''.join(lines))
-			tmp.close()
-			portable_rename(tmp_name, release_status_file)
-			info("Wrote status to %s", release_status_file)
-		except:
-			os.unlink(tmp_name)
-			raise
+		changed = [name for name in self.fields if getattr(self, name) != self._saved[name]]
+		if not changed: return
+		now = _monotonic()
+		lines = ["%s=%s\n" % (name, getattr(self, name) or '') for name in changed]
+		lines.append("# time=%.3f duration=%.3f phase=%s\n" % (time.time(), now - self._last_save, ','.join(changed)))
+		with open(self._path, 'a') as stream:
+			stream.write(''.join(lines))
+		for name in changed:
+			self._saved[name] = getattr(self, name)
+		self._last_save = now
+		info("Recorded %s in %s", ', '.join(changed), self._path)
+
+	def get_timings(self):
+		"""Read the journal's timing records.
+		@return: a list of (phase, duration) pairs, where phase is a comma-separated list of the fields saved at the end of it"""
+		timings = []
+		if os.path.isfile(self._path):
+			for line in file(self._path):
+				if not line.startswith('# '): continue
+				record = dict(field.split('=', 1) for field in line[2:].split())
+				timings.append((record['phase'], float(record['duration'])))
+		return timings
 
 def host(address):
 	if hasattr(address, 'hostname'):
@@ -150,81 +278,362 @@ def port(address):
 		else:
 			return None
 
-def get_http_size(url, ttl = 1):
-	assert url.lower().startswith('http://')
+class ConnectionPool:
+	"""Keeps HTTP(S) and FTP connections open so that several size checks
+	on the same server can share one connection. Safe to use from several threads."""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.idle = {}		# (scheme, host, port) -> [connection]
+
+	def _get(self, key, connect):
+		with self.lock:
+			idle = self.idle.get(key, None)
+			if idle:
+				return idle.pop(), True
+		return connect(), False
+
+	def _put(self, key, conn):
+		with self.lock:
+			self.idle.setdefault(key, []).append(conn)
+
+	def get_http_size(self, url, ttl = 1):
+		import httplib, socket
+		scheme = url.split(':', 1)[0].lower()
+		assert scheme in ('http', 'https'), url
+
+		address = urlparse.urlparse(url)
+		if scheme == 'https':
+			key = (scheme, host(address), port(address) or 443)
+			connect = lambda: httplib.HTTPSConnection(key[1], key[2])
+		else:
+			key = (scheme, host(address), port(address) or 80)
+			connect = lambda: httplib.HTTPConnection(key[1], key[2])
 
-	address = urlparse.urlparse(url)
-	http = httplib.HTTPConnection(host(address), port(address) or 80)
+		parts = url.split('/', 3)
+		if len(parts) == 4:
+			path = parts[3]
+		else:
+			path = ''
 
-	parts = url.split('/', 3)
-	if len(parts) == 4:
-		path = parts[3]
-	else:
-		path = ''
+		http, reused = self._get(key, connect)
+		try:
+			http.request('HEAD', '/' + path, headers = {'Host': host(address)})
+			response = http.getresponse()
+		except (httplib.HTTPException, socket.error):
+			http.close()
+			if not reused:
+				raise
+			# The server probably closed the idle connection; try again with a new one
+			http = connect()
+			http.request('HEAD', '/' + path, headers = {'Host': host(address)})
+			response = http.getresponse()
+		try:
+			response.read()
+			if response.status == 200:
+				return response.getheader('Content-Length')
+			elif response.status in (301, 302):
+				new_url_rel = response.getheader('Location') or response.getheader('URI')
+				new_url = urlparse.urljoin(url, new_url_rel)
+			else:
+				raise SafeException("HTTP error: got status code %s" % response.status)
+		finally:
+			response.close()
+			if response.will_close:
+				http.close()
+			else:
+				self._put(key, http)
 
-	http.request('HEAD', '/' + path, headers = {'Host': host(address)})
-	response = http.getresponse()
-	try:
-		if response.status == 200:
-			return response.getheader('Content-Length')
-		elif response.status in (301, 302):
-			new_url_rel = response.getheader('Location') or response.getheader('URI')
-			new_url = urlparse.urljoin(url, new_url_rel)
+		if ttl:
+			info("Resource moved! Checking new URL %s" % new_url)
+			assert new_url
+			return self.get_http_size(new_url, ttl - 1)
 		else:
-			raise SafeException("HTTP error: got status code %s" % response.status)
-	finally:
-		response.close()
+			raise SafeException('Too many redirections.')
+
+	def get_ftp_size(self, url):
+		import ftplib, socket
+		address = urlparse.urlparse(url)
+		key = ('ftp', host(address), port(address) or 21)
+		def connect():
+			ftp = ftplib.FTP()
+			ftp.connect(key[1], key[2])
+			ftp.login()
+			return ftp
+		ftp, reused = self._get(key, connect)
+		try:
+			try:
+				size = ftp.size(url.split('/', 3)[3])
+			except (ftplib.error_temp, socket.error, EOFError):
+				ftp.close()
+				if not reused:
+					raise
+				ftp = connect()
+				size = ftp.size(url.split('/', 3)[3])
+		except ftplib.error_perm:
+			self._put(key, ftp)	# (e.g. file not found; the session is still fine)
+			raise
+		except:
+			ftp.close()
+			raise
+		self._put(key, ftp)
+		return size
+
+	def get_size(self, url):
+		scheme = urlparse.urlparse(url)[0].lower()
+		if scheme.startswith('http'):
+			return self.get_http_size(url)
+		elif scheme.startswith('ftp'):
+			return self.get_ftp_size(url)
+		else:
+			raise SafeException("Unknown scheme '%s' in '%s'" % (scheme, url))
 
-	if ttl:
-		info("Resource moved! Checking new URL %s" % new_url)
-		assert new_url
-		return get_http_size(new_url, ttl - 1)
-	else:
-		raise SafeException('Too many redirections.')
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle = {}
+
+connections = ConnectionPool()
+
+def get_http_size(url, ttl = 1):
+	return connections.get_http_size(url, ttl)
 
 def get_ftp_size(url):
-	address = urlparse.urlparse(url)
-	ftp = ftplib.FTP(host(address))
-	try:
-		ftp.login()
-		return ftp.size(url.split('/', 3)[3])
-	finally:
-		ftp.close()
+	return connections.get_ftp_size(url)
 
 def get_size(url):
-	scheme = urlparse.urlparse(url)[0].lower()
-	if scheme.startswith('http'):
-		return get_http_size(url)
-	elif scheme.startswith('ftp'):
-		return get_ftp_size(url)
-	else:
-		raise SafeException("Unknown scheme '%s' in '%s'" % (scheme, url))
-
-def unpack_tarball(archive_file):
-	tar = tarfile.open(archive_file, 'r:bz2')
-	members = [m for m in tar.getmembers() if m.name != 'pax_global_header']
-	#tar.extractall('.', members = members) # Python >= 2.5 only
-	for tarinfo in members:
-		tarinfo = copy.copy(tarinfo)
+	return connections.get_size(url)
+
+def _extract_stream(tar, target_dir):
+	# Extract members as they are read, without keeping a list of them all.
+	# Directories are created read-write and only get their real
+	# permissions and mtimes once everything inside them has been written.
+	directories = []
+	created = set([target_dir])
+	while True:
+		tarinfo = tar.next()
+		if tarinfo is None:
+			break
+		tar.members = []
+
+		if tarinfo.name == 'pax_global_header': continue
 		tarinfo.mode |= 0600
 		tarinfo.mode &= 0755
-		tar.extract(tarinfo, '.')
+
+		path = os.path.join(target_dir, os.path.normpath(tarinfo.name))
+		parent = os.path.dirname(path)
+		if parent not in created:
+			if not os.path.isdir(parent):
+				os.makedirs(parent)
+			created.add(parent)
+
+		if tarinfo.isdir():
+			if not os.path.isdir(path):
+				os.mkdir(path, 0700)
+			created.add(path)
+			directories.append((path, tarinfo))
+		elif tarinfo.isreg():
+			source = tar.extractfile(tarinfo)
+			with open(path, 'wb') as target:
+				shutil.copyfileobj(source, target)
+			os.chmod(path, tarinfo.mode)
+			os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+		else:
+			tar.extract(tarinfo, target_dir)
+
+	directories.reverse()
+	for path, tarinfo in directories:
+		os.chmod(path, tarinfo.mode)
+		os.utime(path, (tarinfo.mtime, tarinfo.mtime))
+
+def unpack_tarball(archive_file, target_dir = '.'):
+	with tracing.span('unpack ' + os.path.basename(archive_file), 'archive') as span:
+		span.add_bytes(os.path.getsize(archive_file))
+		# (BZ2File is much faster than tarfile's own 'r|bz2' decompressor)
+		stream = bz2.BZ2File(archive_file)
+		try:
+			unpack_tar_stream(stream, target_dir)
+		finally:
+			stream.close()
+
+def unpack_tar_stream(stream, target_dir = '.'):
+	"""Extract an uncompressed tar stream into target_dir."""
+	import tarfile
+	tar = tarfile.open(fileobj = stream, mode = 'r|')
+	try:
+		_extract_stream(tar, target_dir)
+	finally:
+		tar.close()
+
+_archive_digests = {}
+
+def get_archive_digest(archive_file):
+	"""Return the SHA-256 digest of archive_file (cached for as long as the file is unchanged)."""
+	st = os.stat(archive_file)
+	key = (os.path.abspath(archive_file), st.st_size, st.st_mtime)
+	digest = _archive_digests.get(key, None)
+	if digest is None:
+		sha = hashlib.sha256()
+		with open(archive_file, 'rb') as stream:
+			while True:
+				data = stream.read(1 << 20)
+				if not data: break
+				sha.update(data)
+		digest = _archive_digests[key] = sha.hexdigest()
+	return digest
+
+def get_extraction_cache(archive_file):
+	return os.path.join(os.path.dirname(os.path.abspath(archive_file)), extraction_cache_dir)
+
+def get_pristine_tree(archive_file):
+	# A copy of the archive's contents which we never modify, named after its digest
+	cache = get_extraction_cache(archive_file)
+	tree = os.path.join(cache, get_archive_digest(archive_file))
+	if not os.path.isdir(tree):
+		if not os.path.isdir(cache):
+			os.mkdir(cache)
+		tmp = tempfile.mkdtemp(prefix = 'tmp-', dir = cache)
+		try:
+			unpack_tarball(archive_file, tmp)
+		except:
+			ro_rmtree(tmp)
+			raise
+		try:
+			portable_rename(tmp, tree)
+		except OSError:
+			if not os.path.isdir(tree): raise
+			ro_rmtree(tmp)		# Another process extracted it at the same time
+	else:
+		info("Using cached extraction of %s", archive_file)
+	return tree
+
+def unpack_tarball_cached(archive_file):
+	"""Like unpack_tarball, but only decompresses each archive once. Later calls
+	copy the files from a pristine extracted tree in the extraction cache (using
+	reflinks where the file-system supports them)."""
+	if platform.system() != 'Linux':
+		unpack_tarball(archive_file)
+		return
+	tree = get_pristine_tree(archive_file)
+	items = [os.path.join(tree, name) for name in os.listdir(tree)]
+	if items:
+		check_call(['cp', '-a', '--reflink=auto'] + items + ['.'])
+
+def remove_extraction_cache(archive_file):
+	cache = get_extraction_cache(archive_file)
+	if os.path.isdir(cache):
+		info("Deleting extraction cache %s", cache)
+		ro_rmtree(cache)
+
+def write_compressed(child, archive_file, jobs = None):
+	"""Compress child's stdout into archive_file (as bzip2) and wait for child to exit.
+	@return: the child's exit status"""
+	try:
+		stream = open(archive_file, 'wb')
+		try:
+			with tracing.span('compress ' + os.path.basename(archive_file), 'archive') as span:
+				span.add_bytes(compress.compress_stream(child.stdout, stream, jobs = jobs))
+		finally:
+			stream.close()
+	except:
+		child.stdout.close()
+		child.wait()
+		if os.path.exists(archive_file):
+			os.unlink(archive_file)
+		raise
+	return child.wait()
+
+def make_tarball(archive_file, directory, jobs = None):
+	"""Create archive_file as a .tar.bz2 archive of directory."""
+	info("Creating %s from %s", archive_file, directory)
+	child = subprocess.Popen(['tar', 'cf', '-', directory], stdout = subprocess.PIPE)
+	status = write_compressed(child, archive_file, jobs)
+	if status:
+		if os.path.exists(archive_file):
+			os.unlink(archive_file)
+		raise SafeException("Command failed with exit code %d:\ntar cf - %s" % (status, directory))
+
+class VersionIndex:
+	"""A sorted list of versions, for finding the neighbours of a given version quickly."""
+	def __init__(self, versions):
+		"""@param versions: version strings, in any order"""
+		self._set(sorted((model.parse_version(v), v) for v in versions))
+
+	def _set(self, entries):
+		self.entries = entries
+		self.keys = [parsed for parsed, v in entries]
+
+	def get_previous(self, version):
+		"""Return the highest version lower than version, or None."""
+		i = bisect.bisect_left(self.keys, model.parse_version(version))
+		if i == 0:
+			return None
+		return model.format_version(self.keys[i - 1])
+
+	def get_next(self, version):
+		"""Return the lowest version higher than version, or None."""
+		i = bisect.bisect_right(self.keys, model.parse_version(version))
+		if i == len(self.keys):
+			return None
+		return model.format_version(self.keys[i])
+
+	def save(self, stream, key):
+		json.dump({'key': key, 'entries': self.entries}, stream)
+
+	@staticmethod
+	def load(stream, key):
+		"""Load an index written by save.
+		@return: the index, or None if it was saved with a different key"""
+		data = json.load(stream)
+		if data['key'] != key:
+			return None
+		index = VersionIndex([])
+		index._set([(parsed, str(v)) for parsed, v in data['entries']])
+		return index
 
 def load_feed(path):
 	with open(path, 'rb') as stream:
 		return model.ZeroInstallFeed(qdom.parse(stream), local_path = path)
 
+def get_feed_versions(feed):
+	"""@return: a list of (version, stability, id) tuples, one for each implementation in feed"""
+	return [(impl.get_version(), impl.upstream_stability and str(impl.upstream_stability), impl.id)
+		for impl in feed.implementations.values()]
+
+def _get_feed_versions_key(feed_path):
+	st = os.stat(feed_path)
+	return [st.st_mtime, st.st_size, get_archive_digest(feed_path)]
+
+def load_feed_versions(feed_path):
+	"""Like get_feed_versions(load_feed(feed_path)), but uses the index in feed_path + '.versions'
+	if it is still valid (the feed's mtime, size and digest are unchanged), and creates it if not."""
+	index = feed_path + '.versions'
+	if os.path.exists(index):
+		try:
+			with open(index) as stream:
+				data = json.load(stream)
+			if data['key'] == _get_feed_versions_key(feed_path):
+				info("Loaded versions from index %s", index)
+				return [tuple(str(x) if x is not None else None for x in v) for v in data['versions']]
+			info("Index %s is out of date", index)
+		except Exception, ex:
+			warn("Failed to load index %s: %s", index, ex)
+	versions = get_feed_versions(load_feed(feed_path))
+	save_feed_versions(feed_path, versions)
+	return versions
+
+def save_feed_versions(feed_path, versions):
+	"""Write the index used by load_feed_versions. versions must match the current contents of the feed."""
+	index = feed_path + '.versions'
+	with open(index + '.new', 'w') as stream:
+		json.dump({'key': _get_feed_versions_key(feed_path), 'versions': versions}, stream)
+	portable_rename(index + '.new', index)
+
 def get_archive_basename(impl):
 	# "2" means "path" (for Python 2.4)
 	return os.path.basename(urlparse.urlparse(impl.download_sources[0].url)[2])
 
-def make_readonly_recursive(path):
-	for root, dirs, files in os.walk(path):
-		for d in dirs + files:
-			full = os.path.join(root, d)
-			mode = os.stat(full).st_mode
-			os.chmod(full, mode & 0o555)
-
 def get_archive_url(options, release_version, archive):
 	if not options.archive_dir_public_url:
 		return archive			# Not needed with 0repo
@@ -235,13 +644,18 @@ def get_archive_url(options, release_version, archive):
 	return archive_dir_public_url + archive
 
 def make_archives_relative(feed):
+	from xml.dom import minidom
 	with open(feed, 'rb') as stream:
 		doc = minidom.parse(stream)
+	make_doc_archives_relative(doc)
+	with open(feed, 'wb') as stream:
+		doc.writexml(stream)
+		stream.write(b'\n')
+
+def make_doc_archives_relative(doc):
+	"""Replace each archive or file href in doc with just its basename."""
 	for elem in doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'archive') + doc.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'file'):
 		href = elem.getAttribute('href')
 		assert href, 'Missing href on %r' % elem
 		if '/' in href:
 			elem.setAttribute('href', href.rsplit('/', 1)[1])
-	with open(feed, 'wb') as stream:
-		doc.writexml(stream)
-		stream.write(b'\n')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, shutil, tempfile, threading
+import unittest
+
+sys.path.insert(0, '..')
+
+from zeroinstall import SafeException
+import buildproto
+
+def make_transport():
+	# A local stand-in for e.g. an ssh connection to a build slave
+	to_slave_r, to_slave_w = os.pipe()
+	from_slave_r, from_slave_w = os.pipe()
+	client = buildproto.Connection(os.fdopen(from_slave_r, 'rb'), os.fdopen(to_slave_w, 'wb'))
+	slave = buildproto.Connection(os.fdopen(to_slave_r, 'rb'), os.fdopen(from_slave_w, 'wb'))
+	return client, slave
+
+def fake_build(src_feed, archive_file, archive_dir_public_url, target_feed, builder):
+	if 'broken' in archive_file:
+		raise Exception("Compile failed")
+	src = open(archive_file, 'rb').read()
+	with open(os.path.join(os.path.dirname(target_feed), 'hello-%s.tar.bz2' % builder), 'wb') as stream:
+		stream.write('binary of ' + src)
+	with open(target_feed, 'w') as stream:
+		stream.write('<feed url="%s">%s</feed>' % (archive_dir_public_url, open(src_feed).read()))
+
+class TestBuildProto(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-')
+		self.client, slave = make_transport()
+		self.slave_thread = threading.Thread(target = buildproto.serve, args = (slave, fake_build))
+		self.slave_thread.start()
+
+	def tearDown(self):
+		self.client.output.close()
+		self.slave_thread.join()
+		shutil.rmtree(self.tmp)
+
+	def write(self, name, contents):
+		path = os.path.join(self.tmp, name)
+		with open(path, 'wb') as stream:
+			stream.write(contents)
+		return path
+
+	def testBuild(self):
+		feed = self.write('hello.xml', 'source feed')
+		archive = self.write('hello.tar.bz2', '\0source\n' * 100000)
+		os.mkdir(os.path.join(self.tmp, 'out'))
+		target = os.path.join(self.tmp, 'out', 'binary-host.xml.new')
+
+		# Two builds over the same connection
+		for i in range(2):
+			buildproto.request_build(self.client, feed, archive, 'http://example.com/', target, 'host')
+			self.assertEquals('<feed url="http://example.com/">source feed</feed>', open(target).read())
+			self.assertEquals('binary of ' + '\0source\n' * 100000,
+					open(os.path.join(self.tmp, 'out', 'hello-host.tar.bz2'), 'rb').read())
+			os.unlink(target)
+		self.assertEquals(['hello-host.tar.bz2'], os.listdir(os.path.join(self.tmp, 'out')))
+
+	def testConcurrent(self):
+		# Builds for two targets at once, each with its own slave, writing to the same directory
+		out = os.path.join(self.tmp, 'out')
+		os.mkdir(out)
+		# (as if another build was part-way through receiving its feed)
+		with open(os.path.join(out, 'feed.xml'), 'w') as stream:
+			stream.write('partial')
+		other_client, other_slave = make_transport()
+		other_thread = threading.Thread(target = buildproto.serve, args = (other_slave, fake_build))
+		other_thread.start()
+		try:
+			requests = []
+			for client, builder in [(self.client, 'a'), (other_client, 'b')]:
+				feed = self.write('src-%s.xml' % builder, 'source feed for ' + builder)
+				archive = self.write('hello-%s-src.tar.bz2' % builder, 'source')
+				target = os.path.join(out, 'binary-%s.xml.new' % builder)
+				requests.append((client, feed, archive, target, builder))
+			for i in range(20):
+				errors = []
+				def build(client, feed, archive, target, builder):
+					try:
+						buildproto.request_build(client, feed, archive, 'http://example.com/', target, builder)
+					except Exception, ex:
+						errors.append(ex)
+				threads = [threading.Thread(target = build, args = request) for request in requests]
+				for t in threads: t.start()
+				for t in threads: t.join()
+				self.assertEquals([], errors)
+				for client, feed, archive, target, builder in requests:
+					self.assertEquals('<feed url="http://example.com/">source feed for %s</feed>' % builder, open(target).read())
+					os.unlink(target)
+			self.assertEquals(['feed.xml', 'hello-a.tar.bz2', 'hello-b.tar.bz2'], sorted(os.listdir(out)))
+			self.assertEquals('partial', open(os.path.join(out, 'feed.xml')).read())
+		finally:
+			other_client.output.close()
+			other_thread.join()
+
+	def testFailure(self):
+		feed = self.write('hello.xml', 'source feed')
+		archive = self.write('broken.tar.bz2', 'source')
+		try:
+			buildproto.request_build(self.client, feed, archive, 'http://example.com/', os.path.join(self.tmp, 'bin.xml'), 'host')
+			assert 0
+		except SafeException, ex:
+			self.assertEquals('Build failed: Compile failed', str(ex))
+
+	def testCorrupted(self):
+		out = os.path.join(self.tmp, 'msg')
+		with open(out, 'wb') as stream:
+			buildproto.Connection(None, stream).send('url', 'http://example.com/')
+		data = open(out, 'rb').read().replace('example', 'exbmple')
+		from StringIO import StringIO
+		try:
+			buildproto.Connection(StringIO(data), None).receive()
+			assert 0
+		except buildproto.ProtocolError, ex:
+			assert 'Digest mismatch' in str(ex), ex
+
+suite = unittest.makeSuite(TestBuildProto)
+if __name__ == '__main__':
+	unittest.main()
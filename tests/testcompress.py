@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, bz2, tarfile, subprocess, random
+from StringIO import StringIO
+import unittest
+
+sys.path.insert(0, '..')
+
+import compress
+
+def make_data(size):
+	rand = random.Random(size)
+	words = ['release', 'feed', 'archive', 'version', '\n', '0', 'AAAA', '\0' * 40]
+	data = []
+	while size > 0:
+		word = rand.choice(words)
+		data.append(word)
+		size -= len(word)
+	return ''.join(data)
+
+class TestCompress(unittest.TestCase):
+	def setUp(self):
+		self.old_chunk_size = compress.chunk_size
+		compress.chunk_size = 10000
+
+	def tearDown(self):
+		compress.chunk_size = self.old_chunk_size
+
+	def roundtrip(self, data, jobs):
+		out = StringIO()
+		size = compress.compress_stream(StringIO(data), out, jobs = jobs)
+		self.assertEquals(len(data), size)
+		return out.getvalue()
+
+	def testEmpty(self):
+		compressed = self.roundtrip('', jobs = 1)
+		self.assertEquals(bz2.compress(''), compressed)
+		self.assertEquals('', bz2.decompress(compressed))
+
+	def testSingleBlock(self):
+		data = make_data(5000)
+		self.assertEquals(data, bz2.decompress(self.roundtrip(data, jobs = 1)))
+
+	def testManyBlocks(self):
+		# (bz2.decompress only reads the first stream, so this also
+		# checks that we produced a single stream)
+		data = make_data(123457)
+		for jobs in [1, 2, 5]:
+			self.assertEquals(data, bz2.decompress(self.roundtrip(data, jobs = jobs)))
+
+	def testWorstCase(self):
+		# Runs of four bytes expand the most during bzip2's initial RLE
+		data = ('AAAABBBB' * self.old_chunk_size)[:self.old_chunk_size]
+		compress._compress_chunk(data)		# (asserts that it fits in one block)
+
+	def testBzip2(self):
+		data = make_data(54321)
+		child = subprocess.Popen(['bzip2', '-dc'], stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+		stdout, unused = child.communicate(self.roundtrip(data, jobs = 3))
+		self.assertEquals(0, child.returncode)
+		self.assertEquals(data, stdout)
+
+	def testTarfile(self):
+		tar_data = StringIO()
+		tar = tarfile.open(fileobj = tar_data, mode = 'w')
+		for i in range(5):
+			info = tarfile.TarInfo('dir/file-%d' % i)
+			contents = make_data(i * 7000)
+			info.size = len(contents)
+			tar.addfile(info, StringIO(contents))
+		tar.close()
+
+		tar = tarfile.open(fileobj = StringIO(self.roundtrip(tar_data.getvalue(), jobs = 2)), mode = 'r:bz2')
+		self.assertEquals(['dir/file-%d' % i for i in range(5)], tar.getnames())
+		self.assertEquals(make_data(4 * 7000), tar.extractfile('dir/file-4').read())
+
+suite = unittest.makeSuite(TestCompress)
+if __name__ == '__main__':
+	unittest.main()
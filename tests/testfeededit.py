@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, tempfile, shutil, subprocess, tarfile
+import unittest
+
+sys.path.insert(0, '..')
+
+from zeroinstall.support import ro_rmtree
+
+import support, feededit
+
+local_feed = """<?xml version="1.0" ?>
+<?xml-stylesheet type='text/xsl' href='interface.xsl'?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface" uri="http://example.com/hello.xml">
+  <name>Hello</name>
+  <summary>says hello</summary>
+  <feed-for interface="http://example.com/hello.xml"/>
+
+  <group license="OSI Approved :: GNU General Public License (GPL)" main="hello.py" released="2009-01-01" version="1.0-post">
+    <requires interface="http://example.com/lib.xml"/>
+    <implementation id="." stability="testing"/>
+  </group>
+
+  <group version="0.9">
+    <implementation id="sha1new=0123" stability="testing">
+      <manifest-digest sha256new="ABCD"/>
+      <archive href="http://example.com/hello-0.9.tar.bz2" size="100"/>
+    </implementation>
+  </group>
+</interface>
+"""
+
+# What we write for local_feed after setting the version, release date and main and
+# adding an archive with the digests below, in the layout 0publish uses (attributes
+# sorted, as minidom writes them). This records our own output, to catch changes to it;
+# the comparisons with 0publish itself are in testSame0publish*, which need $0PUBLISH.
+golden_feed = """<?xml version="1.0" ?>
+<?xml-stylesheet type='text/xsl' href='interface.xsl'?>
+<interface uri="http://example.com/hello.xml" xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>Hello</name>
+  <summary>says hello</summary>
+  <feed-for interface="http://example.com/hello.xml"/>
+
+  <group license="OSI Approved :: GNU General Public License (GPL)" main="hello2.py" released="2009-02-03" version="1.1">
+    <requires interface="http://example.com/lib.xml"/>
+    <implementation id="sha1new=4d2a9bdb4bc7a30a5bc9e2b2afc8e7f1b3a12cde" stability="testing">
+      <manifest-digest sha256new="RXOV3PJDUJDSGUSTUOYTGRIRY6HCNDMPSGTFD7JKMZ3ZBZELDJBA"/>
+      <archive extract="hello-1.1" href="http://example.com/releases/1.1/hello-1.1.tar.bz2" size="1234"/>
+    </implementation>
+  </group>
+
+  <group version="0.9">
+    <implementation id="sha1new=0123" stability="testing">
+      <manifest-digest sha256new="ABCD"/>
+      <archive href="http://example.com/hello-0.9.tar.bz2" size="100"/>
+    </implementation>
+  </group>
+</interface>
+"""
+
+digests = ('sha1new=4d2a9bdb4bc7a30a5bc9e2b2afc8e7f1b3a12cde', 'sha256new_RXOV3PJDUJDSGUSTUOYTGRIRY6HCNDMPSGTFD7JKMZ3ZBZELDJBA')
+
+class TestFeedEdit(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-')
+		self.feed = os.path.join(self.tmp, 'hello.xml')
+		with open(self.feed, 'w') as stream:
+			stream.write(local_feed)
+
+	def tearDown(self):
+		ro_rmtree(self.tmp)
+
+	def edit(self):
+		return feededit.FeedEditor(self.feed)
+
+	def get_impl(self, editor, id):
+		impls = [impl for impl in editor.get_implementations() if impl.getAttribute('id') == id]
+		self.assertEquals(1, len(impls))
+		return impls[0]
+
+	def read(self):
+		with open(self.feed) as stream:
+			return stream.read()
+
+	def testGroupAttributes(self):
+		editor = self.edit()
+		editor.set_version('1.1')
+		editor.set_released('2009-02-03')
+		editor.save()
+
+		editor = self.edit()
+		impl = editor.get_local_implementation()
+		group = impl.parentNode
+		# Changed where they were set, not added to the implementation
+		self.assertEquals('1.1', group.getAttribute('version'))
+		self.assertEquals('2009-02-03', group.getAttribute('released'))
+		assert not impl.hasAttribute('version')
+		assert not impl.hasAttribute('released')
+
+		# Removing an inherited attribute removes it from the group
+		editor.set_released('')
+		assert not group.hasAttribute('released')
+		assert not impl.hasAttribute('released')
+
+		# Attributes that aren't set anywhere go on the implementation
+		editor.set_main('hello2.py')
+		self.assertEquals('hello2.py', group.getAttribute('main'))
+		editor.get_local_implementation().parentNode.removeAttribute('main')
+		editor.set_main('hello3.py')
+		self.assertEquals('hello3.py', impl.getAttribute('main'))
+
+	def testImplementationAttributes(self):
+		with open(self.feed, 'w') as stream:
+			stream.write(local_feed.replace('<implementation id="." stability="testing"/>',
+							'<implementation id="." stability="testing" version="1.0-post"/>'))
+		editor = self.edit()
+		editor.set_version('1.1')
+		impl = editor.get_local_implementation()
+		self.assertEquals('1.1', impl.getAttribute('version'))
+		self.assertEquals('1.0-post', impl.parentNode.getAttribute('version'))
+
+	def testStability(self):
+		editor = self.edit()
+		editor.set_stability('stable', '0.9')
+		editor.save()
+
+		editor = self.edit()
+		self.assertEquals('stable', self.get_impl(editor, 'sha1new=0123').getAttribute('stability'))
+		self.assertEquals('testing', editor.get_local_implementation().getAttribute('stability'))
+
+		# The version is inherited from the group here too
+		editor.set_stability('buggy', '1.0-post')
+		self.assertEquals('buggy', editor.get_local_implementation().getAttribute('stability'))
+		self.assertEquals('stable', self.get_impl(editor, 'sha1new=0123').getAttribute('stability'))
+
+	def testAddArchive(self):
+		editor = self.edit()
+		editor.add_archive('http://example.com/releases/1.1/hello-1.1.tar.bz2', 1234, 'hello-1.1', digests)
+		editor.save()
+
+		editor = self.edit()
+		impl = self.get_impl(editor, digests[0])
+		assert not impl.hasAttribute('local-path')
+		children = [x for x in impl.childNodes if x.nodeType == x.ELEMENT_NODE]
+		self.assertEquals(['manifest-digest', 'archive'], [x.localName for x in children])
+		for child in children:
+			self.assertEquals(feededit.XMLNS_IFACE, child.namespaceURI)
+		digest, archive = children
+		self.assertEquals([('sha256new', digests[1].split('_', 1)[1])], digest.attributes.items())
+		self.assertEquals('http://example.com/releases/1.1/hello-1.1.tar.bz2', archive.getAttribute('href'))
+		self.assertEquals('1234', archive.getAttribute('size'))
+		self.assertEquals('hello-1.1', archive.getAttribute('extract'))
+
+		# No longer local
+		self.assertRaises(support.SafeException, editor.get_local_implementation)
+
+	def testAddArchiveNoExtract(self):
+		editor = self.edit()
+		editor.add_archive('http://example.com/hello.tar.bz2', 10, None, digests)
+		archive = editor.doc.getElementsByTagNameNS(feededit.XMLNS_IFACE, 'archive')[0]
+		assert not archive.hasAttribute('extract')
+
+	def testGolden(self):
+		editor = self.edit()
+		editor.set_version('1.1')
+		editor.set_released('2009-02-03')
+		editor.save()
+
+		editor = self.edit()
+		editor.set_main('hello2.py')
+		editor.add_archive('http://example.com/releases/1.1/hello-1.1.tar.bz2', 1234, 'hello-1.1', digests)
+		editor.save()
+
+		self.assertEquals(golden_feed, self.read())
+
+	def run_both(self, *steps):
+		"""Apply each step (a dict of publish options) to a copy of the feed with 0publish
+		and to the original with support.edit_feed, and check that the results are identical."""
+		if '0PUBLISH' not in os.environ:
+			self.skipTest("$0PUBLISH not set (run the tests with 0launch to compare with 0publish)")
+		expected = os.path.join(self.tmp, 'expected.xml')
+		shutil.copyfile(self.feed, expected)
+		for step in steps:
+			subprocess.check_call([os.environ['0PUBLISH']] +
+					['--%s=%s' % (k.replace('_', '-'), v) for k, v in sorted(step.items())] + [expected])
+			support.edit_feed(self.feed, **step)
+		with open(expected) as stream:
+			self.assertEquals(stream.read(), self.read())
+
+	def make_archive(self):
+		src = os.path.join(self.tmp, 'src', 'hello-1.1')
+		os.makedirs(os.path.join(src, 'lib'))
+		with open(os.path.join(src, 'hello2.py'), 'w') as stream:
+			stream.write('print "Hello"\n')
+		os.chmod(os.path.join(src, 'hello2.py'), 0755)
+		with open(os.path.join(src, 'lib', 'data.txt'), 'w') as stream:
+			stream.write('data\n' * 100)
+		os.symlink('hello2.py', os.path.join(src, 'hello'))
+		archive = os.path.join(self.tmp, 'hello-1.1.tar.bz2')
+		tar = tarfile.open(archive, 'w:bz2')
+		tar.add(src, 'hello-1.1')
+		tar.close()
+		return archive
+
+	def testSame0publish(self):
+		self.run_both(dict(set_version = '1.1', set_released = '2009-02-03', set_main = 'hello2.py'))
+
+	def testSame0publishArchive(self):
+		# The same steps as testGolden, but with a real archive (so the digests are
+		# calculated by 0publish on one side and by feededit on the other)
+		archive = self.make_archive()
+		self.run_both(dict(set_version = '1.1', set_released = '2009-02-03'),
+			      dict(set_main = 'hello2.py', archive_url = 'http://example.com/releases/1.1/hello-1.1.tar.bz2',
+				   archive_file = archive, archive_extract = 'hello-1.1'))
+
+	def testSame0publishArchiveNoExtract(self):
+		archive = self.make_archive()
+		self.run_both(dict(archive_url = 'http://example.com/hello-1.1.tar.bz2', archive_file = archive))
+
+suite = unittest.makeSuite(TestFeedEdit)
+if __name__ == '__main__':
+	unittest.main()
@@ -13,7 +13,8 @@ sys.path.insert(0, '..')
 os.environ['http_proxy'] = 'localhost:1111'	# Prevent accidental network access
 
 import support
-import release		# (sets sys.path for 0repo)
+import release
+release.use_0repo()
 import repo.cmd
 
 mydir = os.path.realpath(os.path.dirname(__file__))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, tempfile, subprocess, tarfile
+import unittest
+
+sys.path.insert(0, '..')
+
+from zeroinstall.support import ro_rmtree
+
+import support, sandbox
+
+# Modifies a file, adds a file and a directory and deletes a file
+misbehaving_test = 'cd "$1" && echo changed >> a && touch new && mkdir newdir && touch newdir/f && rm sub/b'
+
+# Rewrites a file with the same size and puts its mtime back
+sneaky_test = 'cd "$1" && mtime=$(stat -c %y a) && echo "original A" > a && touch -d "$mtime" a'
+
+class TestSandbox(unittest.TestCase):
+	def setUp(self):
+		self.old_cwd = os.getcwd()
+		self.tmp = tempfile.mkdtemp(prefix = '0release-')
+		os.chdir(self.tmp)
+		os.makedirs('src/proj-1.0/sub')
+		for name in ['a', 'sub/b']:
+			with open(os.path.join('src/proj-1.0', name), 'w') as stream:
+				stream.write('original %s\n' % name)
+		os.symlink('a', 'src/proj-1.0/link')
+		tar = tarfile.open('proj-1.0.tar.bz2', 'w:bz2')
+		tar.add('src/proj-1.0', 'proj-1.0')
+		tar.close()
+		support.unpack_tarball_cached('proj-1.0.tar.bz2')
+		self.old_overlay = sandbox._overlay_supported
+
+	def tearDown(self):
+		sandbox._overlay_supported = self.old_overlay
+		os.chdir(self.old_cwd)
+		ro_rmtree(self.tmp)
+
+	def run_test(self, command):
+		test_sandbox = sandbox.TestSandbox('proj-1.0.tar.bz2', 'proj-1.0')
+		subprocess.check_call(test_sandbox.wrap(['sh', '-c', command, '-', os.path.abspath('proj-1.0')]))
+		return test_sandbox.finish()
+
+	def check_pristine(self):
+		self.assertEquals(['a', 'link', 'sub'], sorted(os.listdir('proj-1.0')))
+		self.assertEquals('original a\n', open('proj-1.0/a').read())
+		self.assertEquals('original sub/b\n', open('proj-1.0/sub/b').read())
+		self.assertEquals('a', os.readlink('proj-1.0/link'))
+
+	def testCopy(self):
+		sandbox._overlay_supported = False
+		self.assertEquals([], self.run_test('test -f "$1/a"'))
+		self.assertEquals(['a', 'new', 'newdir', 'sub/b'], self.run_test(misbehaving_test))
+		self.check_pristine()
+		self.assertEquals(['a'], self.run_test(sneaky_test))
+		self.check_pristine()
+
+	def testOverlay(self):
+		sandbox._overlay_supported = None
+		if not sandbox.overlay_supported():
+			self.skipTest("overlay mounts not available")
+		self.assertEquals([], self.run_test('test -f "$1/a"'))
+		self.assertEquals(['a', 'new', 'newdir', 'sub/b'], self.run_test(misbehaving_test))
+		self.check_pristine()
+
+suite = unittest.makeSuite(TestSandbox)
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, tempfile, shutil, subprocess, json
+import unittest
+
+mydir = os.path.realpath(os.path.dirname(__file__))
+zerorelease = os.path.join(mydir, '..', '0release')
+
+# Time allowed from starting to run the 0release script to exiting, in seconds
+# (excluding Python's own start-up). This is generous, so that it only catches
+# something big (e.g. importing all of release.py) on a loaded machine.
+import_budget = 1.0
+
+# Modules our code only imports when needed. Any that zeroinstall imports anyway are ignored.
+lazy_modules = ['release', 'repo', 'compile', 'scm', 'setup', 'support',
+		'httplib', 'ftplib', 'tarfile', 'multiprocessing', 'xml.dom.minidom']
+
+run_script = """
+import sys, time, json, atexit
+start = time.time()
+def report():
+	sys.__stderr__.write('\\n@@' + json.dumps({'time': time.time() - start, 'modules': sorted(sys.modules)}))
+atexit.register(report)
+sys.argv = %r
+sys.path[0] = %r
+execfile(sys.argv[0], {'__name__': '__main__'})
+"""
+
+def run_0release(args, cwd = None, stdin = ''):
+	"""Run 0release with args, returning (time taken, set of modules imported)."""
+	script = run_script % ([zerorelease] + args, os.path.dirname(zerorelease))
+	child = subprocess.Popen([sys.executable, '-c', script], cwd = cwd,
+			stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	unused, stderr = child.communicate(stdin)
+	assert '\n@@' in stderr, stderr
+	result = json.loads(stderr.rsplit('\n@@', 1)[1])
+	return result['time'], set(result['modules'])
+
+def get_zeroinstall_modules():
+	child = subprocess.Popen([sys.executable, '-c',
+		'import sys, json\n'
+		'from zeroinstall.injector import model, qdom, namespaces\n'
+		'from zeroinstall.support import basedir\n'
+		'print json.dumps(sorted(sys.modules))'], stdout = subprocess.PIPE)
+	stdout, unused = child.communicate()
+	return set(json.loads(stdout))
+
+class TestStartup(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def check_lazy(self, modules, expected = []):
+		unexpected = set(lazy_modules) - get_zeroinstall_modules() - set(expected)
+		self.assertEquals([], sorted(unexpected & modules))
+
+	def testVersion(self):
+		taken, modules = run_0release(['--version'])
+		assert 'zeroinstall' not in modules
+		self.check_lazy(modules)
+		assert taken < import_budget, taken
+
+	def testBuildSlave(self):
+		# (no requests on stdin, so it exits straight away)
+		taken, modules = run_0release(['--build-slave'])
+		self.check_lazy(modules, expected = ['compile', 'support'])
+		assert taken < import_budget, taken
+
+	def testSetup(self):
+		feed = os.path.join(mydir, '..', '0release.xml')
+		releases = os.path.join(self.tmp, 'releases')
+		os.mkdir(releases)
+		taken, modules = run_0release([feed], cwd = releases)
+		assert os.path.exists(os.path.join(releases, 'make-release'))
+		self.check_lazy(modules, expected = ['setup', 'support'])
+		assert taken < import_budget, taken
+
+suite = unittest.makeSuite(TestStartup)
+if __name__ == '__main__':
+	unittest.main()
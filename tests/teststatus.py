@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+import sys, os, tempfile, shutil
+import unittest
+
+sys.path.insert(0, '..')
+
+import support
+
+class TestStatus(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix = '0release-')
+		self.path = os.path.join(self.tmp, 'release-status')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def testJournal(self):
+		status = support.Status(self.path)
+		status.release_version = '1.0'
+		status.save()
+		status.tagged = 'true'
+		status.save()
+		status.save()		# (nothing changed)
+
+		status = support.Status(self.path)
+		self.assertEquals('1.0', status.release_version)
+		self.assertEquals('true', status.tagged)
+		self.assertEquals(['release_version', 'tagged'], [phase for phase, duration in status.get_timings()])
+
+	def testTruncated(self):
+		status = support.Status(self.path)
+		status.release_version = '1.0'
+		status.save()
+		# Interrupted while saving the next phase
+		with open(self.path, 'a') as stream:
+			stream.write('tagged=tr')
+
+		status = support.Status(self.path)
+		self.assertEquals('1.0', status.release_version)
+		self.assertEquals(None, status.tagged)
+
+		# The partial line is gone, so the next save starts on a new line
+		status.tagged = 'true'
+		status.save()
+		status = support.Status(self.path)
+		self.assertEquals('1.0', status.release_version)
+		self.assertEquals('true', status.tagged)
+		self.assertEquals(['release_version', 'tagged'], [phase for phase, duration in status.get_timings()])
+
+	def testTruncatedRecord(self):
+		with open(self.path, 'w') as stream:
+			stream.write('release_version=1.0\n# time=1.0 dura')
+		status = support.Status(self.path)
+		self.assertEquals('1.0', status.release_version)
+		self.assertEquals([], status.get_timings())
+
+suite = unittest.makeSuite(TestStatus)
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,150 @@
+# Copyright (C) 2009, Thomas Leonard
+# See the README file for details, or visit http://0install.net.
+
+# Record how long each part of a release takes (for "0release --profile").
+# The result is written in Chrome's trace-event format; load it with
+# chrome://tracing or https://ui.perfetto.dev to see the timeline.
+#
+# Each span records its wall-clock time, the CPU time used by 0release itself
+# and by any child processes that finished during it, and (where it makes sense)
+# the number of bytes processed. CPU times are for the whole process, so they
+# overlap for spans running at the same time in different threads.
+#
+# When profiling isn't enabled, spans do nothing.
+
+import os, sys, time, json, threading, functools, subprocess
+from contextlib import contextmanager
+
+_events = None		# The recorded events (None if we're not profiling)
+_start_time = None
+_lock = threading.Lock()
+
+def start():
+	"""Start recording spans."""
+	global _events, _start_time
+	_events = []
+	_start_time = time.time()
+
+def is_enabled():
+	return _events is not None
+
+class Span:
+	def __init__(self, name, category, args):
+		self.name = name
+		self.category = category
+		self.args = args
+		self.bytes = 0
+		self.start_time = time.time()
+		self.start_times = os.times()
+
+	def add_bytes(self, n):
+		self.bytes += n
+
+	def end(self):
+		end_times = os.times()
+		duration = time.time() - self.start_time
+		args = dict(self.args)
+		args['cpu'] = round((end_times[0] - self.start_times[0]) + (end_times[1] - self.start_times[1]), 3)
+		args['child_cpu'] = round((end_times[2] - self.start_times[2]) + (end_times[3] - self.start_times[3]), 3)
+		if self.bytes:
+			args['bytes'] = self.bytes
+		event = {
+			'name': self.name,
+			'cat': self.category,
+			'ph': 'X',
+			'ts': int((self.start_time - _start_time) * 1000000),
+			'dur': int(duration * 1000000),
+			'pid': os.getpid(),
+			'tid': threading.current_thread().ident,
+			'args': args,
+		}
+		with _lock:
+			if _events is not None:
+				_events.append(event)
+
+class _NullSpan:
+	def add_bytes(self, n):
+		pass
+
+	def end(self):
+		pass
+
+_null_span = _NullSpan()
+
+def begin(name, category, **args):
+	"""Start a span. Call end() on the result when it's finished."""
+	if _events is None:
+		return _null_span
+	return Span(name, category, args)
+
+@contextmanager
+def span(name, category, **args):
+	"""A span covering the body of a "with" statement."""
+	s = begin(name, category, **args)
+	try:
+		yield s
+	finally:
+		s.end()
+
+def traced(name, category = 'phase'):
+	"""Decorator recording a span for each call to the function."""
+	def decorate(fn):
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			with span(name, category):
+				return fn(*args, **kwargs)
+		return wrapper
+	return decorate
+
+def _command_name(args):
+	if isinstance(args, basestring):
+		args = args.split()
+	args = list(args)
+	if not args:
+		return 'sh'
+	if args[:2] == ['sh', '-c'] and len(args) > 2:
+		return _command_name(args[2])
+	name = os.path.basename(args[0])
+	if name == 'git' and len(args) > 1:
+		name += ' ' + args[1]
+	return name
+
+class Popen(subprocess.Popen):
+	"""A subprocess.Popen with a span from when it starts until it has been waited for."""
+	def __init__(self, args, category = 'subprocess', **kwargs):
+		self._span = begin(_command_name(args), category, command = repr(args))
+		try:
+			subprocess.Popen.__init__(self, args, **kwargs)
+		except:
+			self._span.end()
+			raise
+
+	def wait(self):
+		code = subprocess.Popen.wait(self)
+		if self._span:
+			self._span.end()
+			self._span = None
+		return code
+
+def finish(path, stream = sys.stdout, top = 15):
+	"""Write the trace to path and print a summary of the most expensive spans."""
+	global _events
+	events, _events = _events, None
+	if events is None:
+		return
+	with open(path, 'w') as trace:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+
+	totals = {}
+	for event in events:
+		key = (event['cat'], event['name'])
+		count, dur, cpu, child_cpu, nbytes = totals.get(key, (0, 0, 0, 0, 0))
+		args = event['args']
+		totals[key] = (count + 1, dur + event['dur'], cpu + args['cpu'], child_cpu + args['child_cpu'], nbytes + args.get('bytes', 0))
+
+	print >>stream, "\nProfile written to %s. Top costs (spans may overlap):" % path
+	print >>stream, "%10s %8s %8s %6s %10s  %s" % ('wall (s)', 'cpu', 'children', 'calls', 'MB', 'span')
+	for key in sorted(totals, key = lambda k: -totals[k][1])[:top]:
+		count, dur, cpu, child_cpu, nbytes = totals[key]
+		print >>stream, "%10.2f %8.2f %8.2f %6d %10s  %s: %s" % (dur / 1e6, cpu, child_cpu, count,
+				nbytes and '%.1f' % (nbytes / 1e6) or '-', key[0], key[1])